@@ -8,6 +8,8 @@ setup(name='Splango',
       author='Shimon Rura',
       author_email='shimon@rura.org',
       url='http://github.com/shimon/Splango',
-      packages=['splango','splango.templatetags'],
-      package_data={'splango': ['templates/*.html', 'templates/*/*.html']}
+      packages=['splango','splango.templatetags','splango.management',
+                'splango.management.commands'],
+      package_data={'splango': ['templates/*.html', 'templates/*/*.html',
+                                'sql/*.sql']}
 )
@@ -1,34 +1,62 @@
 from django.conf import settings
 
 import logging
-from django.utils.encoding import smart_unicode
 from django.core.urlresolvers import reverse, NoReverseMatch
 
 from splango.models import Subject, Experiment, Enrollment, GoalRecord
+from splango.registry import experiment_registry
+from splango.assignment import new_assignment_key
+from splango.sinks import DatabaseSink, WriteBehindSink, get_sink
+from splango.identity import CookieState, uses_cookie
+from splango import humans
+from splango.injection import inject_into_response
+from splango.stats import RequestStats, instrumented
 
 SPLANGO_STATE = "SPLANGO_STATE"
 SPLANGO_SUBJECT = "SPLANGO_SUBJECT"
 SPLANGO_QUEUED_UPDATES = "SPLANGO_QUEUED_UPDATES"
+SPLANGO_ASSIGNMENT_KEY = "SPLANGO_ASSIGNMENT_KEY"
+SPLANGO_VARIANTS = "SPLANGO_VARIANTS"
 S_UNKNOWN = "UNKNOWN"
 S_HUMAN = "HUMAN"
 
+# values for settings.SPLANGO_ASSIGNMENT
+ASSIGN_RANDOM = "random"
+ASSIGN_HASH = "hash"
+
 # borrowed from debug_toolbar
 _HTML_TYPES = ('text/html', 'application/xhtml+xml')
 
-# borrowed from debug_toolbar
-def replace_insensitive(string, target, replacement):
-    """
-    Similar to string.replace() but is case insensitive
-    Code borrowed from: http://forums.devshed.com/python-programming-11/case-insensitive-string-replace-490921.html
-    """
-    no_case = string.lower()
-    index = no_case.rfind(target.lower())
-    if index >= 0:
-        return string[:index] + replacement + string[index + len(target):]
-    else: # no results so return the original string
-        return string
 
+def coalesce_actions(actions):
+    """Reduce a queue of (action, params) to the actions that matter: the
+    first enrollment in each experiment and the first of each goal, which
+    keeps the first extra given for it."""
+
+    result = []
+    enrolled = set()
+    goals = {}
+
+    for (action, params) in actions:
+        if action == "enroll":
+            if params["exp_name"] not in enrolled:
+                enrolled.add(params["exp_name"])
+                result.append((action, params))
+
+        elif action == "log_goal":
+            first = goals.get(params["goal_name"])
+
+            if first is None:
+                goals[params["goal_name"]] = params = dict(params)
+                result.append((action, params))
+
+            elif params.get("extra") and not first.get("extra"):
+                first["extra"] = params["extra"]
 
+        else:
+            raise RuntimeError("Unknown queue action '%s'." % action)
+
+    return result
 
 
 class RequestExperimentManager:
@@ -36,11 +64,32 @@ class RequestExperimentManager:
     def __init__(self, request):
         #logging.debug("REM init")
         self.request = request
-        self.user_at_init = request.user
+        self.user_at_init = request.user # still lazy; not evaluated here
         self.queued_actions = []
+        self._state = None
+        self.stats = RequestStats()
+        # exp_name -> variant, for experiments declared during this request
+        self.variants = {}
+        # exp_name -> variant of the subject's enrollments, loaded on first use
+        self._subject_variants = None
+
+    @property
+    def state(self):
+        """The visitor's Splango state, loaded on first use so requests
+        that never touch an experiment or goal don't pay for it."""
+        if self._state is None:
+            self.load_state()
+        return self._state
+
+    def load_state(self):
+        # per-visitor state lives in the session, or in a signed cookie
+        if uses_cookie():
+            self._state = CookieState.load(self.request)
+        else:
+            self._state = self.request.session
 
-        if self.request.session.get(SPLANGO_STATE) is None:
-            self.request.session[SPLANGO_STATE] = S_UNKNOWN
+        if self._state.get(SPLANGO_STATE) is None:
+            self._state[SPLANGO_STATE] = S_UNKNOWN
             
             if self.is_first_visit():
                 
@@ -53,29 +102,54 @@ class RequestExperimentManager:
                 if first_visit_goalname:
                     self.log_goal(first_visit_goalname)
 
+        if (self._state[SPLANGO_STATE] != S_HUMAN
+            and humans.is_human(self.request)):
+            # confirmed without a request of its own
+            self.confirm_human()
+
     def enqueue(self, action, params):
         self.queued_actions.append( (action, params) )
 
 
-    def process_from_queue(self, action, params):
-        logging.info("SPLANGO! dequeued: %s (%s)" % (str(action), repr(params)))
+    def process_from_queue(self, action, params, sink=None):
+        self.process_queue([ (action, params) ], sink)
 
-        if action == "enroll":
-            exp = Experiment.objects.get(name=params["exp_name"])
-            exp.enroll_subject_as_variant(self.get_subject(),
-                                          params["variant"])
+    def process_queue(self, actions, sink=None):
+        """Send queued actions to the sink, coalesced, as one batch of
+        enrollments and one of goals."""
 
-        elif action == "log_goal":
-            g = GoalRecord.record(self.get_subject(), 
-                                  params["goal_name"], 
-                                  params["request_info"],
-                                  extra=params.get("extra"))
+        actions = coalesce_actions(actions)
 
-            logging.info("SPLANGO! goal! %s" % str(g))
+        if not actions:
+            return
 
+        logging.info("SPLANGO! dequeued %d actions" % len(actions))
 
-        else:
-            raise RuntimeError("Unknown queue action '%s'." % action)
+        if sink is None:
+            sink = get_sink()
+
+        subject = self.get_subject()
+
+        enrollments = [ (params["exp_name"], params["variant"])
+                        for (action, params) in actions if action == "enroll" ]
+
+        goals = [ (params["goal_name"], params["request_info"],
+                   params.get("extra"))
+                  for (action, params) in actions if action == "log_goal" ]
+
+        if enrollments:
+            enrolled = sink.enroll_many(subject, enrollments)
+
+            for (exp_name, variant) in enrollments:
+                if enrolled[exp_name] != variant:
+                    # an earlier enrollment wins; remember it from now on
+                    self.remember_variant(exp_name, enrolled[exp_name])
+
+        if goals:
+            sink.record_goals(subject, goals)
+
+            for (goal_name, request_info, extra) in goals:
+                logging.info("SPLANGO! goal! %s" % goal_name)
 
 
     def is_first_visit(self):
@@ -100,6 +174,9 @@ class RequestExperimentManager:
     def render_js(self):
         logging.info("SPLANGO! render_js")
 
+        if humans.confirms_by_cookie():
+            return humans.render_cookie_js()
+
         prejs = ""
         postjs = ""
 
@@ -115,22 +192,44 @@ class RequestExperimentManager:
         return """<script type='text/javascript'>%sjQuery.get("%s");%s</script>""" % (prejs, url, postjs)
         
 
+    @instrumented("confirm_human")
     def confirm_human(self, reqdata=None):
         logging.info("SPLANGO! Human confirmed!")
-        self.request.session[SPLANGO_STATE] = S_HUMAN
+        self.state[SPLANGO_STATE] = S_HUMAN
+
+        sink = get_sink()
 
-        for (action, params) in self.request.session.get(SPLANGO_QUEUED_UPDATES, []):
-            self.process_from_queue(action, params)
+        if (getattr(settings, "SPLANGO_DEFER_CONFIRM", False)
+            and isinstance(sink, DatabaseSink)):
+            # only the subject is created now; the background writer
+            # takes care of the queued enrollments and goals. Other sinks
+            # don't write to the database as they go anyway.
+            sink = WriteBehindSink()
+
+        # pop, so the queue is replayed once rather than on every confirm
+        self.process_queue(self.request.session.pop(SPLANGO_QUEUED_UPDATES, []),
+                           sink)
                 
 
+    @instrumented("finish")
     def finish(self, response):
-        curstate = self.request.session.get(SPLANGO_STATE, S_UNKNOWN)
+        curuser = self.request.user
 
-        #logging.info("SPLANGO! finished... state=%s" % curstate)
+        # login() and logout() replace request.user, so an unchanged user
+        # can be spotted without evaluating it
+        user_changed = (self.user_at_init is not curuser
+                        and self.user_at_init != curuser)
 
-        curuser = self.request.user
+        if (self._state is None and not user_changed
+            and not getattr(settings, "SPLANGO_FIRST_VISIT_GOAL", None)):
+            # nothing used Splango during this request
+            return response
+
+        curstate = self.state.get(SPLANGO_STATE, S_UNKNOWN)
+
+        #logging.info("SPLANGO! finished... state=%s" % curstate)
 
-        if self.user_at_init != curuser:
+        if user_changed:
             logging.info("SPLANGO! user status changed over request: %s --> %s" % (str(self.user_at_init), str(curuser)))
 
             if not(curuser.is_authenticated()):
@@ -143,78 +242,235 @@ class RequestExperimentManager:
                 # an existing Subject for this user, if exists,
                 # or simply set the subject.registered_as field.
 
-                self.request.session[SPLANGO_STATE] = S_HUMAN
+                self.state[SPLANGO_STATE] = S_HUMAN
                 # logging in counts as being proved a human
 
-                old_subject = self.request.session.get(SPLANGO_SUBJECT)
+                old_subject = self.get_stored_subject()
 
                 try:
                     existing_subject = Subject.objects.get(registered_as=curuser)
                     # there is an existing registered subject!
                     if old_subject and old_subject.id != existing_subject.id:
                         # merge old subject's activity into new
-                        old_subject.merge_into(existing_subject)
+                        with self.stats.measure("merge_into"):
+                            old_subject.merge_into(existing_subject)
 
                     # whether we had an old_subject or not, we must 
                     # set session to use our existing_subject
-                    self.request.session[SPLANGO_SUBJECT] = existing_subject
+                    self.store_subject(existing_subject)
+
+                    # the existing subject may be enrolled differently, so
+                    # hashed visitors see its variants from now on
+                    self._subject_variants = None
+
+                    if getattr(settings, "SPLANGO_ASSIGNMENT", ASSIGN_RANDOM) == ASSIGN_HASH:
+                        self.state[SPLANGO_VARIANTS] = dict(self.get_subject_variants())
+                    else:
+                        self.state.pop(SPLANGO_VARIANTS, None)
 
                 except Subject.DoesNotExist:
                     # promote current subject to registered!
                     sub = self.get_subject()
                     sub.registered_as = curuser
-                    sub.save()
+                    Subject.objects.filter(id=sub.id).update(registered_as=curuser)
 
         if curstate == S_HUMAN:
             # run anything in my queue
-            for (action, params) in self.queued_actions:
-                self.process_from_queue(action, params)
+            self.process_queue(self.queued_actions)
             self.queued_actions = []
 
-        else:
-            # shove queue into session
-            self.request.session.setdefault(SPLANGO_QUEUED_UPDATES, []).extend(self.queued_actions)
+        elif self.queued_actions:
+            # shove queue into session, without the repeats
+            queue = self.request.session.get(SPLANGO_QUEUED_UPDATES, [])
+            self.request.session[SPLANGO_QUEUED_UPDATES] = coalesce_actions(
+                queue + self.queued_actions)
             self.queued_actions = []
 
+        if curstate != S_HUMAN:
             # and include JS if suitable for this response.
             if response['Content-Type'].split(';')[0] in _HTML_TYPES:
-                response.content = replace_insensitive(smart_unicode(response.content), u'</body>', smart_unicode(self.render_js() + u'</body>'))
+                inject_into_response(response, self.render_js())
+
+        if isinstance(self.state, CookieState):
+            self.state.save(response)
 
         return response
         
         
 
+    def get_stored_subject(self):
+        """Return the visitor's Subject, or None if it doesn't have one yet.
+        The cookie only carries the subject's id, so in that case this is
+        an instance with nothing but the id filled in."""
+        sub = self.state.get(SPLANGO_SUBJECT)
+
+        if sub is not None and not isinstance(sub, Subject):
+            sub = Subject(id=sub)
+
+        return sub
+
+
+    def store_subject(self, sub):
+        if isinstance(self.state, CookieState):
+            self.state[SPLANGO_SUBJECT] = sub.id
+        else:
+            self.state[SPLANGO_SUBJECT] = sub
+
+
     def get_subject(self):
-        assert self.request.session[SPLANGO_STATE] == S_HUMAN, "Hey, you can't call get_subject until you know the subject is a human!"
+        assert self.state[SPLANGO_STATE] == S_HUMAN, "Hey, you can't call get_subject until you know the subject is a human!"
 
-        sub = self.request.session.get(SPLANGO_SUBJECT)
+        sub = self.get_stored_subject()
 
         if not sub:
-            sub = self.request.session[SPLANGO_SUBJECT] = Subject()
+            sub = Subject()
             sub.save()
+            self.store_subject(sub)
             logging.info("SPLANGO! created subject: %s" % str(sub))
         
         return sub
 
 
-    def declare_and_enroll(self, exp_name, variants):
+    def get_assignment_key(self):
+        """Return the stable key this visitor's variants are hashed from,
+        creating one on first use."""
+        key = self.state.get(SPLANGO_ASSIGNMENT_KEY)
+
+        if not key:
+            key = self.state[SPLANGO_ASSIGNMENT_KEY] = new_assignment_key()
+
+        return key
+
+
+    def get_subject_variants(self):
+        """Map the name of each experiment the subject is enrolled in to
+        its variant, read in one query the first time it's needed."""
+        if self._subject_variants is None:
+            sub = self.get_stored_subject()
+
+            if sub is None:
+                self._subject_variants = {}
+            else:
+                self._subject_variants = dict(
+                    Enrollment.objects.filter(subject=sub.id).values_list(
+                        "experiment__name", "variant"))
+
+        return self._subject_variants
+
+
+    def declared_variant(self, exp_name):
+        """The variant this request was given for exp_name, or None if it
+        hasn't been declared yet."""
+        return self.variants.get(exp_name)
+
+
+    def remember_variant(self, exp_name, variant):
+        variants = self.state.setdefault(SPLANGO_VARIANTS, {})
+        variants[exp_name] = variant
+
+        limit = getattr(settings, "SPLANGO_MAX_REMEMBERED_VARIANTS", 30)
+
+        if len(variants) > limit:
+            # keeps the signed cookie well under browsers' 4KB limit
+            self.forget_variants(variants, limit, keep=exp_name)
+
+        self.state.modified = True
+
+
+    def forget_variants(self, variants, limit, keep):
+        """Cut the remembered variants down to limit, keeping keep. Those
+        of concluded, paused or deleted experiments go first; the rest are
+        simply hashed again if they're declared again."""
+
+        live = set(Experiment.objects.filter(
+                name__in=list(variants), winner="", active=True)
+                   .values_list("name", flat=True))
+
+        for name in sorted(variants, key=lambda name: name in live):
+            if len(variants) <= limit:
+                break
+
+            if name != keep:
+                del variants[name]
+
+
+    @instrumented("declare_and_enroll")
+    def declare_and_enroll(self, exp_name, variants, weights=None):
+        # templates, includes and views often declare the same experiment;
+        # only the first declaration in a request does any work
+        v = self.variants.get(exp_name)
+
+        if v is None:
+            v = self.variants[exp_name] = self.choose_variant(exp_name, variants, weights)
+
+        return v
+
+
+    def choose_variant(self, exp_name, variants, weights=None):
         e = Experiment.declare(exp_name, variants)
 
-        if self.request.session[SPLANGO_STATE] != S_HUMAN:
+        # concluded, paused or throttled experiments are decided from the
+        # cached definition, without enrolling anyone
+        if e.winner:
+            return e.winner
+
+        if not e.active:
+            return e.get_default_variant()
+
+        if e.exposure < 100 and not e.exposes(self.get_assignment_key()):
+            return e.get_default_variant()
+
+        if weights is None and not e.uses_bandit():
+            weights = e.get_weights()
+
+        assignment = getattr(settings, "SPLANGO_ASSIGNMENT", ASSIGN_RANDOM)
+
+        if assignment == ASSIGN_HASH:
+            return self.enroll_by_hash(e, weights)
+
+        if self.state[SPLANGO_STATE] != S_HUMAN:
             logging.info("SPLANGO! choosing new random variant for non-human")
-            v = e.get_random_variant()
+            v = e.get_random_variant(weights)
             self.enqueue("enroll", { "exp_name": e.name, "variant": v })
 
         else:
-            sub = self.get_subject()
-            sv = e.get_variant_for(sub)
-            v = sv.variant
-            logging.info("SPLANGO! got variant %s for subject %s" % (str(v),str(sub)))
+            subject_variants = self.get_subject_variants()
+            v = subject_variants.get(e.name)
+
+            if v is None:
+                sub = self.get_subject()
+                v = subject_variants[e.name] = e.get_variant_for(sub, weights).variant
+                logging.info("SPLANGO! got variant %s for subject %s" % (str(v),str(sub)))
 
         return v
 
 
+    def enroll_by_hash(self, exp, weights=None):
+        """Assign a variant from the visitor's assignment key. The
+        enrollment is queued only the first time; after that the variant
+        comes straight from the visitor's stored state."""
+
+        v = self.state.get(SPLANGO_VARIANTS, {}).get(exp.name)
+
+        if v is None:
+            if exp.uses_bandit() and not weights:
+                # the choice is remembered, so needn't be reproducible
+                v = exp.get_random_variant()
+            else:
+                salt = getattr(settings, "SPLANGO_HASH_SALT", "")
+                v = exp.get_hashed_variant(self.get_assignment_key(),
+                                           weights=weights, salt=salt)
+            self.remember_variant(exp.name, v)
+            self.enqueue("enroll", { "exp_name": exp.name, "variant": v })
+
+        return v
+
+
+    @instrumented("log_goal")
     def log_goal(self, goal_name, extra=None):
+        if self._state is None:
+            # finish() only deals with the queue once state is loaded
+            self.load_state()
 
         request_info = GoalRecord.extract_request_info(self.request)
 
@@ -222,3 +478,44 @@ class RequestExperimentManager:
                                    "request_info": request_info,
                                    "extra": extra })
 
+
+
+class NullExperimentManager:
+    """Stands in for RequestExperimentManager on requests Splango ignores
+    (see splango.exclusion): everyone sees the winner, if one is set, or
+    else the first variant. Nothing is recorded and the session is never
+    touched; experiments are looked up but not created."""
+
+    def __init__(self, request):
+        self.request = request
+        self.variants = {}
+
+    def declare_and_enroll(self, exp_name, variants, weights=None):
+        v = self.variants.get(exp_name)
+
+        if v is None:
+            e = experiment_registry.get(exp_name)
+
+            if e is None:
+                found = list(Experiment.objects.filter(name=exp_name)[:1])
+
+                if found:
+                    e = found[0]
+                    experiment_registry.put(e)
+
+            v = e.winner if e is not None and e.winner else variants[0]
+            self.variants[exp_name] = v
+
+        return v
+
+    def declared_variant(self, exp_name):
+        return self.variants.get(exp_name)
+
+    def log_goal(self, goal_name, extra=None):
+        pass
+
+    def confirm_human(self, reqdata=None):
+        pass
+
+    def finish(self, response):
+        return response
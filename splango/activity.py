@@ -0,0 +1,152 @@
+"""The activity log of an experiment variant and a goal, a page at a time.
+
+The log interleaves the enrollments in the variant of subjects that reached
+the goal with those subjects' records of the goal, ordered by time. The
+database does the interleaving, with a UNION of the two tables, and each
+page starts where the previous one ended (keyset pagination) rather than
+at an OFFSET, so every page costs the same however deep it is.
+
+A position in the log is a cursor string, as made by encode_cursor.
+"""
+
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+
+from splango.models import Enrollment, GoalRecord, Subject
+
+# entries of the same time are ordered by kind, then by id
+KIND_ENROLLMENT = 0
+KIND_GOAL = 1
+
+PAGE_SIZE = 100
+
+
+class Activity(object):
+
+    def __init__(self, created, kind, id, subject_id, registered, goal_id,
+                 req_REMOTE_ADDR, req_path, req_HTTP_REFERER):
+        if isinstance(created, basestring):
+            # sqlite hands back the text of a UNIONed timestamp
+            created = parse_datetime(created)
+
+        self.created = created
+        self.kind = kind
+        self.id = id
+        self.subject_id = subject_id
+        self.registered = bool(registered)
+        self.goal_id = goal_id
+        self.req_REMOTE_ADDR = req_REMOTE_ADDR
+        self.req_path = req_path
+        self.req_HTTP_REFERER = req_HTTP_REFERER
+
+    def is_enrollment(self):
+        return self.kind == KIND_ENROLLMENT
+
+    def key(self):
+        return (self.created, self.kind, self.id)
+
+
+def encode_cursor(activity):
+    return "%s_%d_%d" % (activity.created.isoformat(), activity.kind,
+                         activity.id)
+
+
+def decode_cursor(cursor):
+    """The (created, kind, id) a cursor points at, or None if it's not a
+    valid cursor."""
+    try:
+        created, kind, id = cursor.rsplit("_", 2)
+        created = parse_datetime(created)
+        kind, id = int(kind), int(id)
+    except (ValueError, AttributeError):
+        return None
+
+    if created is None:
+        return None
+
+    return created, kind, id
+
+
+def _after(kind, key):
+    """SQL condition and parameters selecting the rows of the given kind
+    that come after key in (created, kind, id) order. Written per table so
+    each side of the UNION can use its index on created."""
+
+    if key is None:
+        return "1 = 1", []
+
+    created, after_kind, after_id = key
+
+    if kind > after_kind:
+        return "%(t)s.created >= %%s", [created]
+    elif kind < after_kind:
+        return "%(t)s.created > %%s", [created]
+    else:
+        return ("(%(t)s.created > %%s OR (%(t)s.created = %%s AND %(t)s.id > %%s))",
+                [created, created, after_id])
+
+
+def activity_page(exp, variant, goal, after=None, limit=PAGE_SIZE):
+    """Up to limit Activity entries for exp, variant and goal, starting
+    after the (created, kind, id) key given."""
+
+    qn = connection.ops.quote_name
+    names = { "e": qn(Enrollment._meta.db_table),
+              "g": qn(GoalRecord._meta.db_table),
+              "s": qn(Subject._meta.db_table),
+              "addr": qn("req_REMOTE_ADDR"),
+              "path": qn("req_path"),
+              "referer": qn("req_HTTP_REFERER") }
+
+    e_after, e_params = _after(KIND_ENROLLMENT, after)
+    g_after, g_params = _after(KIND_GOAL, after)
+
+    sql = """
+SELECT created, kind, id, subject_id, registered_as_id, goal_id,
+       %(addr)s, %(path)s, %(referer)s
+FROM (
+  SELECT e.created AS created, %(enrollment)d AS kind, e.id AS id,
+         e.subject_id AS subject_id, s.registered_as_id AS registered_as_id,
+         NULL AS goal_id, NULL AS %(addr)s, NULL AS %(path)s,
+         NULL AS %(referer)s
+  FROM %(e)s e JOIN %(s)s s ON s.id = e.subject_id
+  WHERE e.experiment_id = %%s AND e.variant = %%s AND %(e_after)s
+    AND EXISTS (SELECT 1 FROM %(g)s g
+                WHERE g.subject_id = e.subject_id AND g.goal_id = %%s)
+  UNION ALL
+  SELECT g.created, %(goal)d, g.id, g.subject_id, s.registered_as_id,
+         g.goal_id, g.%(addr)s, g.%(path)s, g.%(referer)s
+  FROM %(g)s g JOIN %(s)s s ON s.id = g.subject_id
+  WHERE g.goal_id = %%s AND %(g_after)s
+    AND EXISTS (SELECT 1 FROM %(e)s e
+                WHERE e.subject_id = g.subject_id
+                  AND e.experiment_id = %%s AND e.variant = %%s)
+) activity
+ORDER BY created, kind, id
+LIMIT %(limit)d
+""" % dict(names, enrollment=KIND_ENROLLMENT, goal=KIND_GOAL,
+           e_after=e_after % { "t": "e" }, g_after=g_after % { "t": "g" },
+           limit=limit)
+
+    params = ([exp.pk, variant] + e_params + [goal.pk]
+              + [goal.pk] + g_params + [exp.pk, variant])
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+    return [ Activity(*row) for row in cursor.fetchall() ]
+
+
+def iter_activity(exp, variant, goal, after=None, chunk_size=1000):
+    """All Activity entries after the given key, fetched a page at a time."""
+
+    while True:
+        page = activity_page(exp, variant, goal, after, chunk_size)
+
+        for activity in page:
+            yield activity
+
+        if len(page) < chunk_size:
+            return
+
+        after = page[-1].key()
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from splango.models import Subject, Goal, GoalRecord, Enrollment, Experiment, ExperimentReport
+from splango.models import Subject, Goal, GoalRecord, Enrollment, Experiment, ExperimentReport, Archive
 
 admin.site.register(Subject)
 
@@ -17,10 +17,14 @@ class EnrollmentAdmin(admin.ModelAdmin):
 admin.site.register(Enrollment, EnrollmentAdmin)
 
 class ExperimentAdmin(admin.ModelAdmin):
-    list_display = ("name","variants_commasep","created")
+    list_display = ("name","variants_commasep","allocation","exposure","active","winner","created")
 admin.site.register(Experiment, ExperimentAdmin)
 
 class ExperimentReportAdmin(admin.ModelAdmin):
     list_display = ("title", "experiment")
 admin.site.register(ExperimentReport, ExperimentReportAdmin)
 
+class ArchiveAdmin(admin.ModelAdmin):
+    list_display = ("name", "enrollments", "goalrecords", "counted_to", "created")
+admin.site.register(Archive, ArchiveAdmin)
+
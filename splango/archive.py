@@ -0,0 +1,176 @@
+"""Moving old enrollments and goal records out of the live tables.
+
+archive() writes rows to a gzipped file of splango.writer event tuples,
+the same format FileSink writes, with each row's creation time last, and
+deletes them from the database a batch at a time. The file starts with a
+header line naming it and the rollups' high-water mark, and an Archive row
+records it until it's restored. It archives:
+
+  * the enrollments of concluded experiments (those with a winner), and/or
+  * enrollments and goal records created before a cutoff, as long as
+    they belong to experiments that are concluded or paused. Goal records
+    of a subject still enrolled in a live experiment stay, however old,
+    so a returning visitor keeps their variant and isn't counted twice.
+
+Only rows the rollup table has already counted (created up to the
+RollupMark) are archived, so rollup-based reports keep their numbers;
+reports computed from the live tables lose them. `manage.py
+splango_import_events` loads an archive back with the rows' original
+times, without counting them in the rollups again. While any archive is
+out, the rollups can't be rebuilt from scratch.
+"""
+
+import datetime
+import gzip
+import json
+import os
+
+from django.db import transaction
+from django.db.models import Q
+
+from splango.models import Archive, Enrollment, GoalRecord, RollupMark
+from splango.sinks import event_line, format_when, parse_when
+from splango.writer import EVENT_ENROLL, EVENT_GOAL
+
+BATCH_SIZE = 1000
+
+_REQUEST_FIELDS = ("req_HTTP_REFERER", "req_REMOTE_ADDR", "req_path")
+
+
+def _enrollment_event(row):
+    eid, sid, exp_name, variant, created = row
+    return (EVENT_ENROLL, sid, exp_name, variant), created
+
+
+def _goal_event(row):
+    gid, sid, goal_name, referer, addr, path, extra, created = row
+    info = dict(zip(_REQUEST_FIELDS, (referer, addr, path)))
+    return (EVENT_GOAL, sid, goal_name, info, extra), created
+
+
+def archive_rows(queryset, fields, to_event, out, batch_size=BATCH_SIZE):
+    """Write the rows of queryset to out and delete them, batch_size rows
+    at a time in id order. fields are the values_list fields, the first
+    being id, which to_event turns into an (event, created) pair. Returns
+    the number of rows archived."""
+
+    model = queryset.model
+    last_id = 0
+    total = 0
+
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by("id")
+                    .values_list(*fields)[:batch_size])
+
+        if not rows:
+            return total
+
+        for row in rows:
+            event, created = to_event(row)
+            out.write(event_line(event, created))
+
+        out.flush()
+
+        with transaction.commit_on_success():
+            model.objects.filter(id__in=[ row[0] for row in rows ]).delete()
+
+        total += len(rows)
+        last_id = rows[-1][0]
+
+        if len(rows) < batch_size:
+            return total
+
+
+def header_line(name, counted_to):
+    return json.dumps({ "archive": name,
+                        "counted_to": format_when(counted_to) }) + "\n"
+
+
+def read_header(line):
+    """The (name, counted_to) of an archive's first line, or None if the
+    line isn't an archive header."""
+
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return None
+
+    if not isinstance(header, dict) or "archive" not in header:
+        return None
+
+    return header["archive"], parse_when(header["counted_to"])
+
+
+def rollup_mark():
+    marks = list(RollupMark.objects.order_by("id")[:1])
+    return marks[0].mark if marks else None
+
+
+def archive(directory, concluded=True, before=None, batch_size=BATCH_SIZE):
+    """Archive to a new file in directory. Returns (path, enrollments,
+    goal records), with path None if nothing needed archiving."""
+
+    mark = rollup_mark()
+
+    if mark is None:
+        # nothing has been counted, so nothing can go
+        return None, 0, 0
+
+    which = None
+
+    if concluded:
+        which = ~Q(experiment__winner="")
+
+    if before is not None:
+        finished = ~Q(experiment__winner="") | Q(experiment__active=False)
+        old = Q(created__lt=before) & finished
+        which = old if which is None else which | old
+
+        live = Enrollment.objects.filter(experiment__winner="",
+                                         experiment__active=True)
+        goalrecords = (GoalRecord.objects
+                       .filter(created__lte=mark, created__lt=before)
+                       .exclude(subject__in=live.values("subject")))
+    else:
+        goalrecords = GoalRecord.objects.none()
+
+    if which is not None:
+        enrollments = Enrollment.objects.filter(which, created__lte=mark)
+    else:
+        enrollments = Enrollment.objects.none()
+
+    name = "archive-%s.ndjson.gz" % datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    path = os.path.join(directory, name)
+
+    # recorded before any row is deleted, so the rollups can't be rebuilt
+    # without them even if this run dies halfway
+    record = Archive.objects.create(name=name, counted_to=mark)
+
+    out = gzip.open(path, "wb")
+
+    try:
+        out.write(header_line(name, mark))
+
+        n_enrollments = archive_rows(
+            enrollments,
+            ("id", "subject_id", "experiment__name", "variant", "created"),
+            _enrollment_event, out, batch_size)
+
+        n_goalrecords = archive_rows(
+            goalrecords,
+            ("id", "subject_id", "goal__name") + _REQUEST_FIELDS
+            + ("extra", "created"),
+            _goal_event, out, batch_size)
+    finally:
+        out.close()
+
+    if not (n_enrollments or n_goalrecords):
+        os.remove(path)
+        record.delete()
+        return None, 0, 0
+
+    record.enrollments = n_enrollments
+    record.goalrecords = n_goalrecords
+    record.save()
+
+    return path, n_enrollments, n_goalrecords
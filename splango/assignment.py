@@ -0,0 +1,57 @@
+"""Deterministic variant assignment.
+
+A subject's variant is computed from a stable hash of its assignment key,
+the experiment name and a salt, so the same subject always lands in the same
+variant without asking the database which one it was given before.
+"""
+
+import hashlib
+import uuid
+
+_HASH_DIGITS = 15
+_HASH_SCALE = float(16 ** _HASH_DIGITS)
+
+
+def new_assignment_key():
+    """Return a fresh random key identifying a subject for assignment."""
+    return uuid.uuid4().hex
+
+
+def hash_fraction(key, exp_name, salt=""):
+    """Map (salt, experiment, key) onto a float uniformly spread in [0, 1)."""
+    s = u"%s:%s:%s" % (salt, exp_name, key)
+    digest = hashlib.md5(s.encode("utf-8")).hexdigest()
+    return int(digest[:_HASH_DIGITS], 16) / _HASH_SCALE
+
+
+def choose_weighted(variants, weights, fraction):
+    """Pick the variant whose slice of the cumulative weights contains
+    fraction. Missing or None weights mean every variant weighs the same."""
+
+    if not weights:
+        weights = [1] * len(variants)
+
+    if len(weights) != len(variants):
+        raise ValueError("Got %d weights for %d variants."
+                         % (len(weights), len(variants)))
+
+    total = float(sum(weights))
+
+    if total <= 0:
+        raise ValueError("Variant weights must add up to more than zero.")
+
+    point = fraction * total
+    cumulative = 0
+
+    for v, w in zip(variants, weights):
+        cumulative += w
+        if point < cumulative:
+            return v
+
+    # only reachable through float rounding at the very top of the range
+    return variants[-1]
+
+
+def hashed_variant(key, exp_name, variants, weights=None, salt=""):
+    return choose_weighted(variants, weights,
+                           hash_fraction(key, exp_name, salt))
@@ -0,0 +1,160 @@
+"""Multi-armed bandit allocation.
+
+An experiment whose allocation is "thompson" or "epsilon" sends new
+enrollments preferentially to the variants that convert best on its
+bandit_goal:
+
+  thompson  draws a conversion rate for each variant from its beta
+            posterior and picks the highest draw (Thompson sampling)
+  epsilon   picks a variant at random with probability
+            settings.SPLANGO_BANDIT_EPSILON (0.1), else the one with the
+            best conversion rate so far (epsilon-greedy)
+
+Conversion counts come from a process-local snapshot that a background
+thread refreshes every settings.SPLANGO_BANDIT_REFRESH seconds (300), so
+choosing a variant never touches the database. Until the first refresh,
+variants are chosen uniformly.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+ALLOCATE_UNIFORM = "uniform"
+ALLOCATE_THOMPSON = "thompson"
+ALLOCATE_EPSILON = "epsilon"
+
+ALLOCATIONS = (
+    (ALLOCATE_UNIFORM, "uniform"),
+    (ALLOCATE_THOMPSON, "bandit: Thompson sampling"),
+    (ALLOCATE_EPSILON, "bandit: epsilon-greedy"),
+    )
+
+
+def thompson(variants, counts):
+    """counts maps variant to (enrolled, converted)."""
+    best, best_draw = None, -1
+
+    for v in variants:
+        enrolled, converted = counts.get(v, (0, 0))
+        draw = random.betavariate(converted + 1,
+                                  max(enrolled - converted, 0) + 1)
+
+        if draw > best_draw:
+            best, best_draw = v, draw
+
+    return best
+
+
+def epsilon_greedy(variants, counts, epsilon):
+    if random.random() < epsilon:
+        return random.choice(variants)
+
+    def rate(v):
+        enrolled, converted = counts.get(v, (0, 0))
+        return float(converted) / enrolled if enrolled else 0.0
+
+    best_rate = max(rate(v) for v in variants)
+
+    return random.choice([ v for v in variants if rate(v) == best_rate ])
+
+
+class BanditSnapshot(object):
+    """Per-variant (enrolled, converted) counts of every bandit
+    experiment, as of the last refresh."""
+
+    def __init__(self, refresh_interval=300, background=True):
+        self.refresh_interval = refresh_interval
+        self.background = background
+        self.counts = {}
+        self.refreshed = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get(self, exp_name):
+        """Counts for the named experiment, or None if there are none yet."""
+        if self.background:
+            self.start()
+        return self.counts.get(exp_name)
+
+    def refresh(self):
+        from splango.models import Experiment, ExperimentReport
+
+        counts = {}
+
+        for exp in Experiment.objects.exclude(allocation=ALLOCATE_UNIFORM):
+            if not exp.bandit_goal:
+                continue
+
+            # an unsaved report counts just like a saved one
+            report = ExperimentReport(experiment=exp, funnel=exp.bandit_goal)
+            enrolled, completed, known_goals = report.count_funnel()
+
+            counts[exp.name] = dict(
+                (v, (enrolled.get(v, 0),
+                     completed.get((v, exp.bandit_goal), 0)))
+                for v in exp.get_variants())
+
+        # swapped in whole, so readers never see a partial snapshot
+        self.counts = counts
+        self.refreshed = time.time()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                t = threading.Thread(target=self._run, name="splango-bandit")
+                t.daemon = True
+                t.start()
+                self._thread = t
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception("Splango: failed to refresh bandit counts")
+            finally:
+                connection.close()
+
+            time.sleep(self.refresh_interval)
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot():
+    """Return the process-wide BanditSnapshot, creating it on first use."""
+    global _snapshot
+
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = BanditSnapshot(
+                    refresh_interval=getattr(settings, "SPLANGO_BANDIT_REFRESH", 300))
+
+    return _snapshot
+
+
+def choose_variant(exp):
+    """Choose a variant of exp according to its allocation and the latest
+    snapshot of counts."""
+
+    variants = exp.get_variants()
+    counts = get_snapshot().get(exp.name)
+
+    if counts is None:
+        return random.choice(variants)
+
+    if exp.allocation == ALLOCATE_THOMPSON:
+        return thompson(variants, counts)
+
+    return epsilon_greedy(variants, counts,
+                          getattr(settings, "SPLANGO_BANDIT_EPSILON", 0.1))
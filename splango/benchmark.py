@@ -0,0 +1,243 @@
+"""Benchmarks for Splango's hot paths.
+
+Run them with `manage.py splango_benchmark`, which creates a throwaway
+test database (in memory with sqlite), so the numbers are reproducible and
+nothing touches real data. Each benchmark reports wall time and database
+queries per operation.
+"""
+
+import random
+import time
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.cache import SessionStore
+from django.db import connection
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test.client import RequestFactory
+
+import splango
+from splango.middleware import ExperimentsMiddleware
+from splango.models import (Enrollment, Experiment, ExperimentReport, Goal,
+                            GoalRecord, Subject)
+from splango.registry import experiment_registry
+
+# rows per bulk_create; small enough for sqlite's variable limit
+INSERT_CHUNK = 100
+
+PAGE = "<html><head></head><body>%s</body></html>" % ("<p>lorem ipsum</p>" * 500)
+
+TEMPLATE = """{% load splangotags %}
+{% experiment "bench_tpl" variants "control,free,trial" %}
+{% hyp "bench_tpl" "control" %}sign up{% endhyp %}
+{% hyp "bench_tpl" "free" %}sign up for free{% endhyp %}
+{% hyp "bench_tpl" "trial" %}sign up for a trial{% endhyp %}
+"""
+
+
+class Result(object):
+
+    def __init__(self, name, ops, seconds, queries):
+        self.name = name
+        self.ops = ops
+        self.seconds = seconds
+        self.queries = queries
+
+    def ms_per_op(self):
+        return 1000.0 * self.seconds / self.ops
+
+    def ops_per_second(self):
+        return self.ops / self.seconds if self.seconds else float("inf")
+
+    def queries_per_op(self):
+        return float(self.queries) / self.ops
+
+    def __unicode__(self):
+        return u"%-32s %8d ops %10.3f ms/op %10.0f ops/s %8.2f queries/op" % (
+            self.name, self.ops, self.ms_per_op(), self.ops_per_second(),
+            self.queries_per_op())
+
+    __str__ = __unicode__
+
+
+def measure(name, ops, fn):
+    """Call fn(i) for i in range(ops), timing it and counting queries."""
+
+    connection.use_debug_cursor = True
+    connection.queries = []
+
+    start = time.time()
+
+    for i in range(ops):
+        fn(i)
+
+    seconds = time.time() - start
+    queries = len(connection.queries)
+
+    connection.queries = []
+    connection.use_debug_cursor = None
+
+    return Result(name, ops, seconds, queries)
+
+
+def _bulk_insert(model, objs):
+    for i in range(0, len(objs), INSERT_CHUNK):
+        model.objects.bulk_create(objs[i:i + INSERT_CHUNK])
+
+
+def _new_subject_ids(n):
+    """Create n subjects and return their ids."""
+    _bulk_insert(Subject, [ Subject() for i in range(n) ])
+    return list(Subject.objects.order_by("-id")
+                .values_list("id", flat=True)[:n])
+
+
+def _request(session=None, user=None):
+    request = RequestFactory().get("/", HTTP_ACCEPT="text/html")
+    request.session = session if session is not None else SessionStore()
+    request.user = user or AnonymousUser()
+    return request
+
+
+def _page_view(request):
+    mw = ExperimentsMiddleware()
+    mw.process_request(request)
+    rem = request.experiments
+    rem.declare_and_enroll("bench_mw_1", ["a", "b"])
+    rem.declare_and_enroll("bench_mw_2", ["a", "b", "c"])
+    rem.log_goal("bench.pageview")
+    mw.process_response(request, HttpResponse(PAGE))
+
+
+def bench_middleware(ops):
+    results = []
+
+    results.append(measure("middleware: anonymous visitor", ops,
+                           lambda i: _page_view(_request())))
+
+    session = SessionStore()
+    session[splango.SPLANGO_STATE] = splango.S_HUMAN
+    results.append(measure("middleware: confirmed human", ops,
+                           lambda i: _page_view(_request(session))))
+
+    user = User.objects.create(username="splango_bench")
+    sub = Subject.objects.create(registered_as=user)
+    session = SessionStore()
+    session[splango.SPLANGO_STATE] = splango.S_HUMAN
+    session[splango.SPLANGO_SUBJECT] = sub
+    results.append(measure("middleware: logged-in user", ops,
+                           lambda i: _page_view(_request(session, user))))
+
+    return results
+
+
+def bench_templates(ops):
+    template = Template(TEMPLATE)
+    session = SessionStore()
+    session[splango.SPLANGO_STATE] = splango.S_HUMAN
+    request = _request(session)
+    ExperimentsMiddleware().process_request(request)
+
+    return [measure("template: experiment + 3 hyps", ops,
+                    lambda i: template.render(Context({"request": request})))]
+
+
+def bench_goal_record(ops):
+    subject_ids = _new_subject_ids(ops)
+    info = {"req_path": "/bench", "req_REMOTE_ADDR": "127.0.0.1"}
+
+    return [measure("GoalRecord.record", ops,
+                    lambda i: GoalRecord.record(Subject(id=subject_ids[i]),
+                                                "bench.goal%d" % (i % 5),
+                                                info))]
+
+
+def bench_merge(ops, per_subject=10):
+    exps = [ Experiment.declare("bench_merge_%d" % i, ["a", "b"])
+             for i in range(per_subject) ]
+    goals = [ Goal.objects.get_or_create(name="bench.merge%d" % i)[0].pk
+              for i in range(per_subject) ]
+
+    subject_ids = _new_subject_ids(2 * ops)
+    enrollments = []
+    goalrecords = []
+
+    for sid in subject_ids:
+        # each pair overlaps in half of its experiments and goals
+        for e in random.sample(exps, per_subject // 2 + 1):
+            enrollments.append(Enrollment(subject_id=sid, experiment_id=e.pk,
+                                          variant="a"))
+        for g in random.sample(goals, per_subject // 2 + 1):
+            goalrecords.append(GoalRecord(subject_id=sid, goal_id=g))
+
+    _bulk_insert(Enrollment, enrollments)
+    _bulk_insert(GoalRecord, goalrecords)
+
+    return [measure("Subject.merge_into (%d rows each)" % (2 * (per_subject // 2 + 1)),
+                    ops,
+                    lambda i: Subject(id=subject_ids[2 * i]).merge_into(
+                        Subject(id=subject_ids[2 * i + 1])))]
+
+
+def populate_experiment(name, enrollments, variants=("a", "b", "c", "d"),
+                        funnel=8):
+    """Create an experiment with the given number of enrolled subjects,
+    each reaching a random-length prefix of a funnel of goals, and return a
+    report on it."""
+
+    exp = Experiment.declare(name, variants)
+    goal_names = [ "%s.step%d" % (name, i) for i in range(funnel) ]
+    goals = [ Goal.objects.get_or_create(name=g)[0].pk for g in goal_names ]
+
+    remaining = enrollments
+    chunk = 10000
+
+    while remaining > 0:
+        n = min(chunk, remaining)
+        remaining -= n
+        subject_ids = _new_subject_ids(n)
+
+        _bulk_insert(Enrollment, [
+                Enrollment(subject_id=sid, experiment_id=exp.pk,
+                           variant=random.choice(variants))
+                for sid in subject_ids ])
+
+        goalrecords = []
+
+        for sid in subject_ids:
+            for g in goals:
+                if random.random() < 0.5:
+                    break
+                goalrecords.append(GoalRecord(subject_id=sid, goal_id=g))
+
+        _bulk_insert(GoalRecord, goalrecords)
+
+    return ExperimentReport.objects.create(experiment=exp, title=name,
+                                           funnel="\n".join(goal_names))
+
+
+def bench_report(sizes, ops=3):
+    results = []
+
+    for size in sizes:
+        rept = populate_experiment("bench_report_%d" % size, size)
+        results.append(measure("ExperimentReport.generate (%d)" % size, ops,
+                               lambda i: rept.generate()))
+
+    return results
+
+
+def run(ops=200, report_sizes=(10000,), seed=0):
+    """Run every benchmark, yielding Results as they finish. Expects an
+    empty database."""
+
+    random.seed(seed)
+    experiment_registry.clear()
+
+    for group in (lambda: bench_middleware(ops),
+                  lambda: bench_templates(ops),
+                  lambda: bench_goal_record(ops),
+                  lambda: bench_merge(ops),
+                  lambda: bench_report(report_sizes)):
+        for result in group():
+            yield result
@@ -0,0 +1,92 @@
+"""Caching pages and fragments that depend on experiment variants.
+
+A cached page is only correct for visitors in the same variants as the
+one it was rendered for. variant_cache_key() enrolls the request in the
+given experiments up front and condenses the result into a short key;
+cache_per_variant caches one rendering of a view per variant combination.
+For fragments, see the hypvariant template tag.
+"""
+
+import hashlib
+
+from functools import wraps
+
+from django.core.cache import cache as default_cache, get_cache
+from django.utils.cache import cc_delim_re, get_cache_key, learn_cache_key
+
+
+def _experiment_items(experiments):
+    if hasattr(experiments, "items"):
+        experiments = experiments.items()
+    return sorted(experiments)
+
+
+def variant_cache_key(request, experiments):
+    """Declare and enroll request in experiments, given as a dict or a list
+    of (name, variants) pairs, and return a short string identifying the
+    resulting combination of variants."""
+
+    rem = request.experiments
+    parts = [ u"%s=%s" % (name, rem.declare_and_enroll(name, variants))
+              for name, variants in _experiment_items(experiments) ]
+
+    return hashlib.md5(u";".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def is_private(response):
+    """Whether response's Cache-Control keeps it out of shared caches."""
+
+    if not response.has_header("Cache-Control"):
+        return False
+
+    directives = [ d.split("=", 1)[0].strip().lower()
+                   for d in cc_delim_re.split(response["Cache-Control"]) ]
+
+    return "private" in directives or "no-store" in directives
+
+
+def cache_per_variant(timeout, experiments, key_prefix="", cache_alias=None):
+    """Like django's cache_page, but keeps a separate copy of the page for
+    each combination of variants of the named experiments:
+
+        @cache_per_variant(600, {"signuptext": ["control", "free", "trial"]})
+        def landing(request):
+            ...
+
+    Only successful GET and HEAD responses are cached, and not those whose
+    Cache-Control says private or no-store. As with cache_page, a copy is
+    kept per value of each header named in the response's Vary. The view
+    must not depend on experiments that aren't listed.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(request, *args, **kwargs)
+
+            cache = get_cache(cache_alias) if cache_alias else default_cache
+            # django's page cache keys add the path and the Vary headers
+            prefix = "splango.%s.%s" % (key_prefix,
+                                        variant_cache_key(request, experiments))
+
+            key = get_cache_key(request, prefix, request.method, cache=cache)
+            response = cache.get(key) if key else None
+
+            if response is None:
+                response = view(request, *args, **kwargs)
+
+                if (response.status_code == 200
+                    and not getattr(response, "streaming", False)
+                    and not is_private(response)):
+                    if hasattr(response, "render") and callable(response.render):
+                        response.render()
+                    key = learn_cache_key(request, response, timeout, prefix,
+                                          cache=cache)
+                    cache.set(key, response, timeout)
+
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,79 @@
+"""Deciding, before any session access, which requests Splango ignores.
+
+Ignored requests get a NullExperimentManager. A request is ignored if:
+
+  * its path starts with one of settings.SPLANGO_EXCLUDE_PATHS (by default
+    STATIC_URL and MEDIA_URL, when set);
+  * its User-Agent contains one of settings.SPLANGO_BOT_USER_AGENTS
+    (case-insensitive; BOT_USER_AGENTS below by default); or
+  * settings.SPLANGO_EXCLUDE_NON_HTML_ACCEPT is True (it's False by
+    default) and it sends an Accept header that allows neither HTML nor
+    */*, as API clients do. Leave this off if goals are logged from AJAX
+    or JSON endpoints, or they'll be dropped.
+"""
+
+from django.conf import settings
+
+BOT_USER_AGENTS = (
+    "bot", "crawl", "spider", "slurp", "archiver", "facebookexternalhit",
+    "mediapartners", "feedfetcher", "pingdom", "curl/", "wget/",
+    "python-requests", "python-urllib", "java/", "libwww-perl",
+    "headlesschrome", "phantomjs",
+    )
+
+_HTML_ACCEPTS = ("text/html", "application/xhtml+xml", "*/*")
+
+
+def excluded_paths():
+    paths = getattr(settings, "SPLANGO_EXCLUDE_PATHS", None)
+
+    if paths is None:
+        paths = [ p for p in (getattr(settings, "STATIC_URL", None),
+                              getattr(settings, "MEDIA_URL", None))
+                  if p and p.startswith("/") ]
+
+    return tuple(paths)
+
+
+def is_bot(request):
+    agent = request.META.get("HTTP_USER_AGENT", "").lower()
+
+    if not agent:
+        return False
+
+    for marker in getattr(settings, "SPLANGO_BOT_USER_AGENTS", BOT_USER_AGENTS):
+        if marker.lower() in agent:
+            return True
+
+    return False
+
+
+def accepts_html(request):
+    accept = request.META.get("HTTP_ACCEPT")
+
+    if not accept:
+        return True
+
+    accept = accept.lower()
+
+    for t in _HTML_ACCEPTS:
+        if t in accept:
+            return True
+
+    return False
+
+
+def is_excluded(request):
+    paths = excluded_paths()
+
+    if paths and request.path.startswith(paths):
+        return True
+
+    if is_bot(request):
+        return True
+
+    if (getattr(settings, "SPLANGO_EXCLUDE_NON_HTML_ACCEPT", False)
+        and not accepts_html(request)):
+        return True
+
+    return False
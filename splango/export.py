@@ -0,0 +1,178 @@
+"""Exporting an experiment's raw data, in constant memory.
+
+Each row is an enrollment joined with one of the subject's goal records:
+
+  subject, registered, variant, enrolled, goal, completed
+
+and a subject that hasn't reached any goal gets a single row with goal and
+completed empty. Enrollments are read in chunks of increasing id, each
+with one more query for its subjects' goal records, so memory use depends
+on the chunk size and not on the size of the tables.
+
+Two formats are written:
+
+  csv      one line per row, with a header line
+  columns  newline-delimited JSON: a header object, then one object per
+           chunk holding a list per column. Variants and goals are stored
+           as indexes into the chunk's lists of variant and goal names,
+           and times as seconds since the epoch (UTC).
+
+`manage.py splango_export` and the experiment page's export links
+write these.
+"""
+
+import calendar
+import csv
+import json
+
+from django.utils import timezone
+
+from splango.models import Enrollment, GoalRecord
+
+FORMAT_CSV = "csv"
+FORMAT_COLUMNS = "columns"
+FORMATS = (FORMAT_CSV, FORMAT_COLUMNS)
+
+COLUMNS = ("subject", "registered", "variant", "enrolled", "goal", "completed")
+
+CHUNK_SIZE = 1000
+
+
+def iter_chunks(exp, chunk_size=CHUNK_SIZE):
+    """Yield lists of export rows for exp, chunk_size enrollments at a
+    time."""
+
+    last_id = 0
+
+    while True:
+        enrollments = list(Enrollment.objects.filter(
+                experiment=exp, id__gt=last_id).order_by("id").values_list(
+                "id", "subject_id", "subject__registered_as", "variant",
+                "created")[:chunk_size])
+
+        if not enrollments:
+            return
+
+        last_id = enrollments[-1][0]
+
+        completions = {}
+
+        for (sid, goal, created) in GoalRecord.objects.filter(
+            subject__in=[ e[1] for e in enrollments ]).order_by(
+            "created").values_list("subject_id", "goal__name", "created"):
+            completions.setdefault(sid, []).append((goal, created))
+
+        rows = []
+
+        for (eid, sid, registered_as, variant, enrolled) in enrollments:
+            for (goal, completed) in completions.get(sid, [(None, None)]):
+                rows.append((sid, registered_as is not None, variant,
+                             enrolled, goal, completed))
+
+        yield rows
+
+        if len(enrollments) < chunk_size:
+            return
+
+
+def _utf8(value):
+    if value is None:
+        return ""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return str(int(value))
+    return unicode(value).encode("utf-8")
+
+
+class Echo(object):
+    """Stands in for a file, so csv.writer hands back each line it
+    writes."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(exp, chunk_size=CHUNK_SIZE):
+    """The export of exp as CSV, a chunk of lines at a time."""
+
+    writer = csv.writer(Echo())
+
+    yield writer.writerow(COLUMNS)
+
+    for rows in iter_chunks(exp, chunk_size):
+        yield "".join(writer.writerow([ _utf8(v) for v in row ])
+                      for row in rows)
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+
+    return calendar.timegm(value.timetuple())
+
+
+def column_lines(exp, chunk_size=CHUNK_SIZE):
+    """The export of exp in the columns format, a line at a time."""
+
+    variants = list(exp.get_variants())
+    variant_index = dict((v, i) for (i, v) in enumerate(variants))
+
+    yield json.dumps({ "experiment": exp.name,
+                       "columns": COLUMNS,
+                       "variants": variants }) + "\n"
+
+    for rows in iter_chunks(exp, chunk_size):
+        goals = sorted(set(row[4] for row in rows if row[4] is not None))
+        goal_index = dict((g, i) for (i, g) in enumerate(goals))
+
+        for (sid, registered, variant, enrolled, goal, completed) in rows:
+            if variant not in variant_index:
+                # enrolled in a variant since dropped from the experiment
+                variant_index[variant] = len(variants)
+                variants.append(variant)
+
+        block = { "rows": len(rows),
+                  "variants": variants,
+                  "goals": goals,
+                  "subject": [ r[0] for r in rows ],
+                  "registered": [ int(r[1]) for r in rows ],
+                  "variant": [ variant_index[r[2]] for r in rows ],
+                  "enrolled": [ _timestamp(r[3]) for r in rows ],
+                  "goal": [ goal_index.get(r[4]) for r in rows ],
+                  "completed": [ _timestamp(r[5]) for r in rows ] }
+
+        yield json.dumps(block, separators=(",", ":")) + "\n"
+
+
+def read_columns(lines):
+    """Turn column_lines output back into rows, with times left as
+    seconds since the epoch."""
+
+    lines = iter(lines)
+    next(lines) # the header
+
+    for line in lines:
+        block = json.loads(line)
+        goals = block["goals"]
+        variants = block["variants"]
+
+        for i in range(block["rows"]):
+            goal = block["goal"][i]
+            yield (block["subject"][i],
+                   bool(block["registered"][i]),
+                   variants[block["variant"][i]],
+                   block["enrolled"][i],
+                   goals[goal] if goal is not None else None,
+                   block["completed"][i])
+
+
+def export_lines(exp, format, chunk_size=CHUNK_SIZE):
+    if format == FORMAT_CSV:
+        return csv_lines(exp, chunk_size)
+    elif format == FORMAT_COLUMNS:
+        return column_lines(exp, chunk_size)
+    raise ValueError("Unknown export format %r" % format)
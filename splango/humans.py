@@ -0,0 +1,101 @@
+"""Confirming visitors as human without a request of their own.
+
+By default, pages for visitors not yet known to be human carry a script
+that fetches /splango/confirm_human/ with jQuery. With
+settings.SPLANGO_CONFIRM = "cookie" the script instead sets a short-lived
+signed cookie, and needs no jQuery; the visitor is confirmed as soon as a
+later request brings the cookie back.
+
+settings.SPLANGO_HUMAN_CLASSIFIER names, by dotted path, a function that
+takes a request and returns True if it is surely from a human. Visitors it
+accepts are confirmed on the spot, so they never get the script at all.
+classify_by_headers below is one such function, based on headers browsers
+send and most bots don't.
+
+Settings:
+
+  SPLANGO_HUMAN_COOKIE_NAME  name of the cookie ("splango_human")
+  SPLANGO_HUMAN_COOKIE_AGE   seconds the cookie is good for (one day)
+"""
+
+from django.conf import settings
+from django.core import signing
+
+from splango.exclusion import is_bot
+from splango.loading import load_from_setting
+
+CONFIRM_AJAX = "ajax"
+CONFIRM_COOKIE = "cookie"
+
+_SIGNING_SALT = "splango.humans"
+_TOKEN_VALUE = "human"
+
+
+def confirms_by_cookie():
+    return getattr(settings, "SPLANGO_CONFIRM", CONFIRM_AJAX) == CONFIRM_COOKIE
+
+
+def cookie_name():
+    return getattr(settings, "SPLANGO_HUMAN_COOKIE_NAME", "splango_human")
+
+
+def cookie_age():
+    return getattr(settings, "SPLANGO_HUMAN_COOKIE_AGE", 60 * 60 * 24)
+
+
+def make_token():
+    return signing.TimestampSigner(salt=_SIGNING_SALT).sign(_TOKEN_VALUE)
+
+
+def has_valid_cookie(request):
+    value = request.COOKIES.get(cookie_name())
+
+    if not value:
+        return False
+
+    try:
+        signing.TimestampSigner(salt=_SIGNING_SALT).unsign(value,
+                                                           max_age=cookie_age())
+    except signing.BadSignature:
+        # expired, tampered with or signed with another SECRET_KEY
+        return False
+
+    return True
+
+
+def render_cookie_js():
+    """A script that marks the browser running it as human."""
+    return ("""<script type='text/javascript'>document.cookie="%s=%s; path=/; max-age=%d";</script>"""
+            % (cookie_name(), make_token(), cookie_age()))
+
+
+def classify_by_headers(request):
+    """True for requests that look like they come from a mainstream
+    browser: a Mozilla-style User-Agent that isn't a known bot, and the
+    Accept, Accept-Language and Accept-Encoding headers browsers always
+    send on page loads."""
+
+    meta = request.META
+
+    return bool(meta.get("HTTP_USER_AGENT", "").startswith("Mozilla/")
+                and not is_bot(request)
+                and "text/html" in meta.get("HTTP_ACCEPT", "")
+                and meta.get("HTTP_ACCEPT_LANGUAGE")
+                and meta.get("HTTP_ACCEPT_ENCODING"))
+
+
+def get_classifier():
+    """Return the configured classifier function, or None."""
+    return load_from_setting("SPLANGO_HUMAN_CLASSIFIER", call=False)
+
+
+def is_human(request):
+    """Whether request can be taken as a human's without asking the
+    browser to confirm it."""
+
+    if has_valid_cookie(request):
+        return True
+
+    classifier = get_classifier()
+
+    return bool(classifier is not None and classifier(request))
@@ -0,0 +1,102 @@
+"""Signed-cookie storage for a visitor's Splango state.
+
+With settings.SPLANGO_IDENTITY = "cookie", the human/unknown state, the
+subject id, the assignment key and the assigned variants travel in one
+compact signed cookie instead of the session, so a confirmed human's
+requests need not load or save the session at all.
+
+Settings:
+
+  SPLANGO_COOKIE_NAME    name of the cookie ("splango")
+  SPLANGO_COOKIE_AGE     lifetime in seconds (two years)
+  SPLANGO_COOKIE_DOMAIN  domain, as for SESSION_COOKIE_DOMAIN (None)
+
+With hash assignment, at most settings.SPLANGO_MAX_REMEMBERED_VARIANTS (30)
+variants are kept, so the cookie stays well under browsers' 4KB limit.
+"""
+
+from django.conf import settings
+from django.core import signing
+
+IDENTITY_SESSION = "session"
+IDENTITY_COOKIE = "cookie"
+
+_SIGNING_SALT = "splango.identity"
+
+# keeps the cookie small; keys not listed are stored as they are
+_SHORT_KEYS = {
+    "SPLANGO_STATE": "s",
+    "SPLANGO_SUBJECT": "i",
+    "SPLANGO_ASSIGNMENT_KEY": "k",
+    "SPLANGO_VARIANTS": "v",
+    }
+_LONG_KEYS = dict((v, k) for (k, v) in _SHORT_KEYS.items())
+
+
+def uses_cookie():
+    return getattr(settings, "SPLANGO_IDENTITY", IDENTITY_SESSION) == IDENTITY_COOKIE
+
+
+def cookie_name():
+    return getattr(settings, "SPLANGO_COOKIE_NAME", "splango")
+
+
+def cookie_age():
+    return getattr(settings, "SPLANGO_COOKIE_AGE", 60 * 60 * 24 * 365 * 2)
+
+
+class CookieState(dict):
+    """A dict that remembers whether it changed, loaded from and saved to
+    the signed Splango cookie. Values must be JSON-serializable."""
+
+    def __init__(self, *args, **kwargs):
+        super(CookieState, self).__init__(*args, **kwargs)
+        self.modified = False
+
+    @classmethod
+    def load(cls, request):
+        value = request.COOKIES.get(cookie_name())
+
+        if not value:
+            return cls()
+
+        try:
+            data = signing.loads(value, salt=_SIGNING_SALT,
+                                 max_age=cookie_age())
+        except signing.BadSignature:
+            # expired, tampered with or signed with another SECRET_KEY
+            return cls()
+
+        return cls((_LONG_KEYS.get(k, k), v) for (k, v) in data.items())
+
+    def dumps(self):
+        return signing.dumps(dict((_SHORT_KEYS.get(k, k), v)
+                                  for (k, v) in self.items()),
+                             salt=_SIGNING_SALT, compress=True)
+
+    def save(self, response):
+        """Set the cookie on response if anything changed."""
+        if self.modified:
+            response.set_cookie(cookie_name(), self.dumps(),
+                                max_age=cookie_age(),
+                                domain=getattr(settings, "SPLANGO_COOKIE_DOMAIN", None),
+                                httponly=True)
+            self.modified = False
+
+    def __setitem__(self, key, value):
+        super(CookieState, self).__setitem__(key, value)
+        self.modified = True
+
+    def __delitem__(self, key):
+        super(CookieState, self).__delitem__(key)
+        self.modified = True
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self.modified = True
+        return super(CookieState, self).pop(key, *args)
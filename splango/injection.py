@@ -0,0 +1,90 @@
+"""Inserting Splango's script before </body> of an HTML response.
+
+Works on the encoded bytes and only looks near the end of the document,
+so the page is never decoded, lowercased or copied more than once. For
+streaming responses the content iterator is wrapped and the script goes
+into the last TAIL_SIZE bytes as they pass through.
+"""
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+_BODY_END = "</body>"
+
+# how far from the end of a page </body> is looked for case-insensitively
+TAIL_SIZE = 4096
+
+
+def find_body_end(content):
+    """Return the index of the last </body> in the byte string content, in
+    any case, or -1. Only the last TAIL_SIZE bytes are lowercased; beyond
+    that just the all-lower and all-upper spellings are found."""
+
+    tail_start = max(0, len(content) - TAIL_SIZE)
+    index = content[tail_start:].lower().rfind(_BODY_END)
+
+    if index >= 0:
+        return tail_start + index
+
+    return max(content.rfind(_BODY_END, 0, tail_start + len(_BODY_END)),
+               content.rfind(_BODY_END.upper(), 0, tail_start + len(_BODY_END)))
+
+
+def inject_before_body_end(content, snippet):
+    """Return content with the byte string snippet inserted before the last
+    </body>, or content unchanged if there is none."""
+
+    index = find_body_end(content)
+
+    if index < 0:
+        return content
+
+    return content[:index] + snippet + content[index:]
+
+
+def _iter_injected(chunks, snippet, charset):
+    # hold back the last TAIL_SIZE bytes, however they were chunked, so a
+    # </body> near the end is still there to be found
+    held = ""
+
+    for chunk in chunks:
+        held += smart_str(chunk, charset)
+
+        if len(held) > TAIL_SIZE:
+            yield held[:-TAIL_SIZE]
+            held = held[-TAIL_SIZE:]
+
+    if held:
+        yield inject_before_body_end(held, snippet)
+
+
+def response_charset(response):
+    return (getattr(response, "charset", None)
+            or getattr(response, "_charset", None)
+            or settings.DEFAULT_CHARSET)
+
+
+def inject_into_response(response, snippet):
+    """Insert snippet (text) before </body> in response, streaming or not."""
+
+    charset = response_charset(response)
+    snippet = smart_str(snippet, charset)
+
+    if getattr(response, "streaming", False):
+        response.streaming_content = _iter_injected(
+            response.streaming_content, snippet, charset)
+
+    elif getattr(response, "_base_content_is_iter", False):
+        # an HttpResponse built from an iterator: wrap it rather than
+        # reading response.content, which would consume it
+        response._container = _iter_injected(
+            response._container, snippet, charset)
+
+    else:
+        response.content = inject_before_body_end(response.content, snippet)
+        return response
+
+    if response.has_header("Content-Length"):
+        del response["Content-Length"]
+
+    return response
@@ -0,0 +1,41 @@
+"""Loading the classes and functions that settings name by dotted path."""
+
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def load_from_setting(name, default=None, call=True):
+    """Return the object named by settings.<name>, or by the dotted path
+    default if that's unset, or None if neither is given. With call, the
+    object (usually a class) is called and the result returned instead.
+    Either way this happens once per process for each path."""
+
+    path = getattr(settings, name, None) or default
+
+    if not path:
+        return None
+
+    key = (path, call)
+    obj = _loaded.get(key)
+
+    if obj is None:
+        module_name, _, attr = path.rpartition(".")
+
+        try:
+            target = getattr(import_module(module_name), attr)
+        except (ImportError, AttributeError, ValueError) as e:
+            raise ImproperlyConfigured("Can't load settings.%s %r: %s" % (name, path, e))
+
+        with _loaded_lock:
+            obj = _loaded.get(key)
+
+            if obj is None:
+                obj = _loaded[key] = target() if call else target
+
+    return obj
@@ -0,0 +1,51 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils import timezone
+
+from splango.archive import BATCH_SIZE, archive
+
+
+class Command(NoArgsCommand):
+    help = ("Move enrollments of concluded experiments, and/or enrollments "
+            "and goal records older than a retention window, into a gzipped "
+            "archive file. The retention window only applies to concluded "
+            "or paused experiments and to goal records of subjects not "
+            "enrolled in a live one. Only rows already counted by "
+            "splango_rollup are moved.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--dir", default=None,
+                    help="Directory to write the archive file to."),
+        make_option("--concluded", action="store_true", default=False,
+                    help="Archive enrollments of experiments with a winner."),
+        make_option("--older-than", type="int", default=None,
+                    help="Archive enrollments and goal records more than this many days old, "
+                    "except those of live experiments and their subjects."),
+        make_option("--batch-size", type="int", default=BATCH_SIZE,
+                    help="Rows moved per transaction (default %d)." % BATCH_SIZE),
+        )
+
+    def handle_noargs(self, **options):
+        if not options["dir"]:
+            raise CommandError("Give a directory for the archive with --dir.")
+
+        if not options["concluded"] and options["older_than"] is None:
+            raise CommandError("Choose what to archive with --concluded and/or --older-than.")
+
+        before = None
+
+        if options["older_than"] is not None:
+            before = timezone.now() - datetime.timedelta(days=options["older_than"])
+
+        path, enrollments, goalrecords = archive(
+            options["dir"], concluded=options["concluded"], before=before,
+            batch_size=options["batch_size"])
+
+        if int(options["verbosity"]) > 0:
+            if path is None:
+                self.stdout.write("Nothing to archive. (Has splango_rollup run?)\n")
+            else:
+                self.stdout.write("Archived %d enrollments and %d goal records to %s.\n"
+                                  % (enrollments, goalrecords, path))
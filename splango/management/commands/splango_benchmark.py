@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from splango import benchmark
+
+
+class Command(NoArgsCommand):
+    help = ("Benchmark Splango's middleware, template tags, goal recording, "
+            "subject merging and reports against a throwaway test database.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--ops", type="int", default=200,
+                    help="Operations per benchmark (default 200)."),
+        make_option("--report-sizes", default="10000",
+                    help="Comma-separated enrollment counts to benchmark reports at (default 10000)."),
+        make_option("--seed", type="int", default=0,
+                    help="Random seed for synthetic data (default 0)."),
+        )
+
+    def handle_noargs(self, **options):
+        sizes = [ int(x) for x in options["report_sizes"].split(",") if x ]
+
+        old_name = connection.creation.create_test_db(verbosity=0)
+
+        try:
+            for result in benchmark.run(ops=options["ops"],
+                                        report_sizes=sizes,
+                                        seed=options["seed"]):
+                self.stdout.write("%s\n" % result)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,46 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from splango import export
+from splango.models import Experiment
+
+
+class Command(BaseCommand):
+    args = "EXPERIMENT"
+    help = ("Write every enrollment in an experiment, joined with the "
+            "subject's goal completions, as CSV or in splango's columns "
+            "format (see splango/export.py).")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--format", choices=export.FORMATS,
+                    default=export.FORMAT_CSV,
+                    help="csv (default) or columns."),
+        make_option("--output", "-o", default=None,
+                    help="File to write to (default: standard output)."),
+        make_option("--chunk-size", type="int", default=export.CHUNK_SIZE,
+                    help="Enrollments read per query (default %d)." % export.CHUNK_SIZE),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Name the experiment to export.")
+
+        try:
+            exp = Experiment.objects.get(name=args[0])
+        except Experiment.DoesNotExist:
+            raise CommandError("No such experiment: %s" % args[0])
+
+        if options["output"]:
+            out = open(options["output"], "wb")
+        else:
+            out = sys.stdout
+
+        try:
+            for chunk in export.export_lines(exp, options["format"],
+                                             options["chunk_size"]):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,64 @@
+import gzip
+import itertools
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from splango.archive import read_header
+from splango.models import Archive
+from splango.rollup import import_events
+from splango.sinks import read_events
+
+
+class Command(BaseCommand):
+    args = "FILE [FILE ...]"
+    help = ("Load event files written by splango.sinks.FileSink, or "
+            "archives written by splango_archive, into the Enrollment and "
+            "GoalRecord tables, skipping duplicates and keeping each "
+            "event's time. Only import files the sink has finished writing.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=1000,
+                    help="Events written per batch (default 1000)."),
+        make_option("--mark-done", action="store_true", default=False,
+                    help="Rename each file to FILE.done once imported."),
+        )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError("Name at least one event file to import.")
+
+        batch_size = options["batch_size"]
+        total = 0
+
+        for path in paths:
+            batch = []
+
+            opener = gzip.open if path.endswith(".gz") else open
+
+            with opener(path) as f:
+                first = f.readline()
+                header = read_header(first)
+                counted_to = header[1] if header else None
+
+                for event in read_events(itertools.chain([first], f)):
+                    batch.append(event)
+
+                    if len(batch) >= batch_size:
+                        import_events(batch, counted_to)
+                        total += len(batch)
+                        batch = []
+
+            import_events(batch, counted_to)
+            total += len(batch)
+
+            if header:
+                # restored: the rollups may be rebuilt without it now
+                Archive.objects.filter(name=header[0]).delete()
+
+            if options["mark_done"]:
+                os.rename(path, path + ".done")
+
+        if int(options["verbosity"]) > 0:
+            self.stdout.write("Imported %d events from %d files.\n" % (total, len(paths)))
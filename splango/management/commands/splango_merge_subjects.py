@@ -0,0 +1,59 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from splango.models import Subject
+
+
+class Command(BaseCommand):
+    args = "[FROM_ID:TO_ID ...]"
+    help = ("Merge each FROM subject's enrollments and goal records into the "
+            "TO subject, then delete FROM. Pairs can also be read from a file "
+            "with --file, one 'FROM_ID TO_ID' pair per line.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--file", dest="pairs_file", default=None,
+                    help="Read subject id pairs from this file ('-' for stdin)."),
+        )
+
+    def parse_pair(self, text):
+        try:
+            from_id, to_id = [ int(x) for x in text.replace(":", " ").split() ]
+        except ValueError:
+            raise CommandError("Bad subject pair '%s'; expected FROM_ID:TO_ID." % text)
+
+        if from_id == to_id:
+            raise CommandError("Can't merge subject #%d into itself." % from_id)
+
+        return from_id, to_id
+
+    def handle(self, *args, **options):
+        pairs = [ self.parse_pair(a) for a in args ]
+
+        if options["pairs_file"]:
+            if options["pairs_file"] == "-":
+                lines = sys.stdin
+            else:
+                lines = open(options["pairs_file"])
+
+            pairs.extend(self.parse_pair(line) for line in lines
+                         if line.strip() and not line.startswith("#"))
+
+        ids = set(i for pair in pairs for i in pair)
+        existing = set(Subject.objects.filter(id__in=ids)
+                       .values_list("id", flat=True))
+
+        merged = 0
+
+        for from_id, to_id in pairs:
+            if from_id not in existing or to_id not in existing:
+                self.stderr.write("Skipping %d -> %d: no such subject.\n" % (from_id, to_id))
+                continue
+
+            Subject(id=from_id).merge_into(Subject(id=to_id))
+            existing.discard(from_id)
+            merged += 1
+
+        if int(options["verbosity"]) > 0:
+            self.stdout.write("Merged %d of %d subject pairs.\n" % (merged, len(pairs)))
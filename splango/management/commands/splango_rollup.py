@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from splango.rollup import update_rollups
+
+
+class Command(NoArgsCommand):
+    help = "Fold new enrollments and goal records into the report rollup table."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--lag", type="int", default=60,
+                    help="Leave rows newer than this many seconds for the next run (default 60)."),
+        make_option("--rebuild", action="store_true", default=False,
+                    help="Throw away all rollups and recount from scratch. Refused while any archive made by splango_archive is unrestored."),
+        )
+
+    def handle_noargs(self, **options):
+        try:
+            mark = update_rollups(lag=options["lag"], rebuild=options["rebuild"])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        if int(options["verbosity"]) > 0:
+            self.stdout.write("Rollups are complete up to %s.\n" % mark)
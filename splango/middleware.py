@@ -1,12 +1,38 @@
-from splango import RequestExperimentManager
+from django.conf import settings
 
-class ExperimentsMiddleware:
+from splango import RequestExperimentManager, NullExperimentManager
+from splango.stats import HEADER
+from splango.exclusion import is_excluded
+
+class ExperimentsMiddleware(object):
+    """Works both in MIDDLEWARE_CLASSES and, on Django versions that have
+    it, in the newer callable-style MIDDLEWARE setting."""
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.process_request(request)
+
+        if response is None:
+            response = self.get_response(request)
+
+        return self.process_response(request, response)
 
     def process_request(self, request):
-        request.experiments = RequestExperimentManager(request)
+        if is_excluded(request):
+            request.experiments = NullExperimentManager(request)
+        else:
+            request.experiments = RequestExperimentManager(request)
         return None
 
     def process_response(self, request, response):
         if getattr(request, "experiments", None):
             request.experiments.finish(response)
+
+            stats = getattr(request.experiments, "stats", None)
+
+            if settings.DEBUG and stats and stats.ops:
+                response[HEADER] = stats.summary()
+
         return response
@@ -1,16 +1,23 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 
 import logging
 
-#from django.db.models import Avg, Max, Min, Count
+from django.db.models import Count, Sum
 
 import random
 
+from splango import bandit, significance
+from splango.assignment import choose_weighted, hash_fraction, hashed_variant
+from splango.registry import experiment_registry
+
 _NAME_LENGTH=30
 
 class Goal(models.Model):
-    name = models.CharField(max_length=_NAME_LENGTH, primary_key=True)
+    name = models.CharField(max_length=_NAME_LENGTH, unique=True)
     created = models.DateTimeField(auto_now_add=True)
 
     def __unicode__(self):
@@ -39,24 +46,39 @@ class Subject(models.Model):
         into the given othersubject, preserving the othersubject's
         enrollments in case of conflict."""
 
-        other_gs = dict(((g.name, 1) for g in othersubject.goals.all()))
-        
-        for gr in self.goalrecord_set.all().select_related("goal"):
-            if gr.goal.name not in other_gs:
-                gr.subject = othersubject
-                gr.save()
-            else:
-                gr.delete()
+        if not transaction.is_managed():
+            with transaction.commit_on_success():
+                self._move_rows_into(othersubject)
+            return
+
+        # inside someone else's transaction (e.g. TransactionMiddleware's
+        # during a login), so use a savepoint rather than ending it
+        sid = transaction.savepoint()
+
+        try:
+            self._move_rows_into(othersubject)
+        except:
+            transaction.savepoint_rollback(sid)
+            raise
+
+        transaction.savepoint_commit(sid)
 
+    def _move_rows_into(self, othersubject):
+        # the other subject's keys are fetched first, rather than used
+        # as a subquery, since MySQL can't UPDATE a table it selects from
+        other_goals = list(GoalRecord.objects.filter(subject=othersubject)
+                           .values_list("goal", flat=True))
 
-        other_exps = dict(( (e.experiment_id,1) for e in othersubject.enrollment_set.all() ))
+        GoalRecord.objects.filter(subject=self).exclude(
+            goal__in=other_goals).update(subject=othersubject)
+        GoalRecord.objects.filter(subject=self).delete()
 
-        for e in self.enrollment_set.all():
-            if e.experiment_id not in other_exps:
-                e.subject = othersubject
-                e.save()
-            else:
-                e.delete()
+        other_exps = list(Enrollment.objects.filter(subject=othersubject)
+                          .values_list("experiment", flat=True))
+
+        Enrollment.objects.filter(subject=self).exclude(
+            experiment__in=other_exps).update(subject=othersubject)
+        Enrollment.objects.filter(subject=self).delete()
 
         self.delete()
 
@@ -86,7 +108,7 @@ class GoalRecord(models.Model):
 
     @classmethod
     def record(cls, subject, goalname, request_info, extra=None):
-        logging.warn("Splango:goalrecord %r" % [subject, goalname, request_info, extra])
+        logging.debug("Splango:goalrecord %r" % [subject, goalname, request_info, extra])
         goal, created = Goal.objects.get_or_create(name=goalname)
 
         gr,created = cls.objects.get_or_create(subject=subject, 
@@ -134,10 +156,24 @@ class Enrollment(models.Model):
 
 class Experiment(models.Model):
     """A named experiment."""
-    name = models.CharField(max_length=_NAME_LENGTH, primary_key=True)
+    name = models.CharField(max_length=_NAME_LENGTH, unique=True)
     variants = models.TextField() # one per line... lame and simple
     created = models.DateTimeField(auto_now_add=True, db_index=True)
 
+    allocation = models.CharField(max_length=10, choices=bandit.ALLOCATIONS,
+                                  default=bandit.ALLOCATE_UNIFORM)
+    bandit_goal = models.CharField(max_length=_NAME_LENGTH, blank=True,
+                                   help_text="The goal a bandit allocation optimizes for.")
+
+    weights = models.CharField(max_length=255, blank=True,
+                               help_text="Relative weights of the variants, comma-separated and in the same order. Leave blank for equal weights.")
+    exposure = models.PositiveSmallIntegerField(default=100,
+                                                help_text="Percentage of visitors included in the experiment. The rest see the first variant and aren't enrolled.")
+    active = models.BooleanField(default=True,
+                                 help_text="Untick to pause: everyone sees the first variant and no one is enrolled.")
+    winner = models.CharField(max_length=_NAME_LENGTH, blank=True,
+                              help_text="Set to conclude the experiment: everyone sees this variant and no one is enrolled.")
+
     subjects = models.ManyToManyField(Subject, through=Enrollment)
     
     def __unicode__(self):
@@ -147,20 +183,78 @@ class Experiment(models.Model):
         self.variants = "\n".join(variantlist)
 
     def get_variants(self):
-        return [ x for x in self.variants.split("\n") if x ]
-
-    def get_random_variant(self):
+        # parsed once per distinct value of self.variants; callers
+        # must not modify the returned list
+        cached = self.__dict__.get("_variants_parsed")
+
+        if cached is None or cached[0] != self.variants:
+            cached = (self.variants,
+                      [ x for x in self.variants.split("\n") if x ])
+            self._variants_parsed = cached
+
+        return cached[1]
+
+    def get_weights(self):
+        """The weights set for the variants, or None for equal weights."""
+        if not self.weights.strip():
+            return None
+        return [ float(w) for w in self.weights.replace(",", " ").split() ]
+
+    def get_default_variant(self):
+        return self.get_variants()[0]
+
+    def exposes(self, key):
+        """Whether the visitor with the given assignment key falls in the
+        exposed percentage of traffic. Raising the exposure only ever adds
+        visitors."""
+        if self.exposure >= 100:
+            return True
+        return hash_fraction(key, self.name, "exposure") * 100 < self.exposure
+
+    def clean(self):
+        try:
+            weights = self.get_weights()
+        except ValueError:
+            raise ValidationError("Weights must be numbers.")
+
+        if weights is not None:
+            if len(weights) != len(self.get_variants()):
+                raise ValidationError("Give one weight per variant.")
+            if sum(weights) <= 0:
+                raise ValidationError("Weights must add up to more than zero.")
+
+        if self.exposure > 100:
+            raise ValidationError("Exposure is a percentage, at most 100.")
+
+        if self.winner and self.winner not in self.get_variants():
+            raise ValidationError("The winner must be one of the variants.")
+
+    def uses_bandit(self):
+        return bool(self.allocation != bandit.ALLOCATE_UNIFORM
+                    and self.bandit_goal)
+
+    def get_random_variant(self, weights=None):
+        if weights:
+            return choose_weighted(self.get_variants(), weights, random.random())
+        if self.uses_bandit():
+            return bandit.choose_variant(self)
         return random.choice(self.get_variants())
 
+    def get_hashed_variant(self, key, weights=None, salt=""):
+        """Return the variant deterministically assigned to the given
+        assignment key. Same key, same variant; no database access."""
+        return hashed_variant(key, self.name, self.get_variants(),
+                              weights=weights, salt=salt)
+
     def variants_commasep(self):
         return ",".join(self.get_variants())
 
-    def get_variant_for(self, subject):
+    def get_variant_for(self, subject, weights=None):
         sv, created = Enrollment.objects.get_or_create(
             subject=subject,
             experiment=self,
             defaults={
-                "variant": self.get_random_variant()
+                "variant": self.get_random_variant(weights)
                 })
         return sv
 
@@ -177,12 +271,24 @@ class Experiment(models.Model):
 
     @classmethod
     def declare(cls, name, variants):
-        e,created = cls.objects.get_or_create(name=name, 
-                                              defaults={
-                "variants":"\n".join(variants) })
+        e = experiment_registry.get(name)
+
+        if e is None:
+            e,created = cls.objects.get_or_create(name=name, 
+                                                  defaults={
+                    "variants":"\n".join(variants) })
+            experiment_registry.put(e)
+
         return e
 
 
+def _invalidate_registered_experiment(sender, instance, **kwargs):
+    experiment_registry.invalidate(instance.name)
+
+post_save.connect(_invalidate_registered_experiment, sender=Experiment)
+post_delete.connect(_invalidate_registered_experiment, sender=Experiment)
+
+
 class ExperimentReport(models.Model):
     """A report on the results of an experiment."""
     experiment = models.ForeignKey(Experiment)
@@ -195,20 +301,138 @@ class ExperimentReport(models.Model):
     def get_funnel_goals(self):
         return [ x.strip() for x in self.funnel.split("\n") if x ]
     
+    def count_funnel(self):
+        """Count enrollments per variant and funnel goal completions per
+        (variant, goal) with two grouped queries. Returns a tuple of
+        (enrolled, completed, known_goals) where enrolled maps variant to
+        count, completed maps (variant, goal name) to count, and
+        known_goals is the set of funnel goals that exist at all.
+
+        With settings.SPLANGO_REPORTS_FROM_ROLLUP the counts come from the
+        ReportRollup table instead (see count_funnel_from_rollup)."""
+
+        if getattr(settings, "SPLANGO_REPORTS_FROM_ROLLUP", False):
+            return self.count_funnel_from_rollup()
+
+        exp = self.experiment
+        goals = self.get_funnel_goals()
+
+        enrolled = dict(Enrollment.objects.filter(experiment=exp)
+                        .values_list("variant")
+                        .annotate(ct=Count("id"))
+                        .order_by())
+
+        completed = dict(((v, g), ct) for (v, g, ct) in
+                         Enrollment.objects.filter(
+                             experiment=exp,
+                             subject__goalrecord__goal__name__in=goals)
+                         .values_list("variant", "subject__goalrecord__goal__name")
+                         .annotate(ct=Count("id"))
+                         .order_by())
+
+        known_goals = set(Goal.objects.filter(name__in=goals)
+                          .values_list("name", flat=True))
+
+        return enrolled, completed, known_goals
+
+    def count_funnel_from_rollup(self):
+        """Like count_funnel, but summed from the pre-aggregated
+        ReportRollup rows, so only as fresh as the last splango_rollup
+        run (see RollupMark)."""
+
+        goals = self.get_funnel_goals()
+        rollups = ReportRollup.objects.filter(experiment=self.experiment)
+
+        enrolled = dict(rollups.filter(goal=ReportRollup.ENROLLED)
+                        .values_list("variant")
+                        .annotate(ct=Sum("count"))
+                        .order_by())
+
+        completed = dict(((v, g), ct) for (v, g, ct) in
+                         rollups.filter(goal__in=goals)
+                         .values_list("variant", "goal")
+                         .annotate(ct=Sum("count"))
+                         .order_by())
+
+        known_goals = set(Goal.objects.filter(name__in=goals)
+                          .values_list("name", flat=True))
+
+        return enrolled, completed, known_goals
+
+    def daily_series(self):
+        """Return per-day counts from the rollup table as a list of
+        (day, rows) pairs in date order. Like generate(), rows holds the
+        enrollment row first and then one per funnel goal; each row is a
+        (goal, counts) pair with goal None for enrollments and counts in
+        variant order."""
+
+        variants = self.experiment.get_variants()
+        goals = [ReportRollup.ENROLLED] + self.get_funnel_goals()
+
+        counts = {}
+
+        for (day, v, g, ct) in (ReportRollup.objects
+                                .filter(experiment=self.experiment,
+                                        goal__in=goals)
+                                .values_list("day", "variant", "goal", "count")):
+            counts[(day, v, g)] = ct
+
+        days = sorted(set(day for (day, v, g) in counts))
+
+        return [ (day, [ (g or None,
+                          [ counts.get((day, v, g), 0) for v in variants ])
+                         for g in goals ])
+                 for day in days ]
+
+    def add_significance(self, row, prev_row):
+        """Add confidence intervals and comparisons with the control (the
+        first variant) to a row of generate(), for the conversion from the
+        previous row's counts."""
+
+        trials = [ vc["val"] for vc in prev_row["variant_counts"] ]
+        # a step can be reached without the one before it; none of the
+        # tests are defined for more successes than trials
+        successes = [ min(vc["val"], n)
+                      for (vc, n) in zip(row["variant_counts"], trials) ]
+
+        row["chi_square"], row["chi_square_p"] = \
+            significance.chi_square_test(successes, trials)
+
+        if row["chi_square_p"] is not None:
+            row["chi_square_p_round"] = "%0.4f" % row["chi_square_p"]
+
+        for vi, vc in enumerate(row["variant_counts"]):
+            low, high = significance.wilson_interval(successes[vi], trials[vi])
+
+            if low is not None:
+                vc.update(ci_low=low, ci_high=high,
+                          ci_low_round=( "%0.2f" % (100*low) ),
+                          ci_high_round=( "%0.2f" % (100*high) ))
+
+            if vi > 0 and trials[0] and trials[vi]:
+                vc["z"], vc["p_value"] = significance.z_test(
+                    successes[0], trials[0], successes[vi], trials[vi])
+                vc["prob_beats_control"] = significance.prob_beats(
+                    successes[0], trials[0], successes[vi], trials[vi])
+                vc["prob_beats_control_round"] = "%0.3f" % vc["prob_beats_control"]
+
+                if vc["p_value"] is not None:
+                    vc["p_value_round"] = "%0.4f" % vc["p_value"]
+
     def generate(self):
         result = []
-        exp = self.experiment
 
         variants = self.experiment.get_variants()
         goals = self.get_funnel_goals()
 
+        enrolled, completed, known_goals = self.count_funnel()
+
         # count initial participation
         variant_counts = []
 
         for v in variants:
-            #variant_counts.append(exp.subjectvariant_set.filter(variant=v).aggregate(ct=Count("variant")).get("ct",0))
             variant_counts.append(
-                dict(val=Enrollment.objects.filter(experiment=exp, variant=v).count(),
+                dict(val=enrolled.get(v, 0),
                      variant_name=v,
                      pct=None,
                      pct_cumulative=1,
@@ -221,22 +445,18 @@ class ExperimentReport(models.Model):
                         "variant_counts": variant_counts })
 
         for previ, goal in enumerate(goals):
-            try:
-                g = Goal.objects.get(name=goal)
-            except Goal.DoesNotExist:
+            goal_exists = goal in known_goals
+
+            if not goal_exists:
                 logging.warn("Splango: No such goal <<%s>>." % goal)
-                g = None
 
             variant_counts = []
 
 
             for vi, v in enumerate(variants):
 
-                if g:
-                    vcount = Enrollment.objects.filter(experiment=exp, 
-                                                       variant=v, 
-                                                       subject__goals=g
-                                                       ).count()
+                if goal_exists:
+                    vcount = completed.get((v, goal), 0)
 
                     prev_count = result[previ]["variant_counts"][vi]["val"]
 
@@ -260,8 +480,62 @@ class ExperimentReport(models.Model):
                                            )
                                       )
 
+            row = { "goal": goal, "variant_counts": variant_counts }
+
+            if goal_exists:
+                self.add_significance(row, result[previ])
 
-            result.append({ "goal": goal, "variant_counts": variant_counts })
+            result.append(row)
 
 
         return result
+
+
+class ReportRollup(models.Model):
+    """Pre-aggregated report counts: how many subjects enrolled in an
+    experiment as a variant reached a goal on a given day. Rows with goal
+    set to ENROLLED count the enrollments themselves, by enrollment day.
+
+    Maintained incrementally by the splango_rollup management command."""
+
+    ENROLLED = ""
+
+    experiment = models.ForeignKey(Experiment)
+    variant = models.CharField(max_length=_NAME_LENGTH)
+    goal = models.CharField(max_length=_NAME_LENGTH, blank=True)
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together= (('experiment', 'variant', 'goal', 'day'),)
+
+    def __unicode__(self):
+        return u"%s/%s %s on %s: %d" % (self.experiment_id, self.variant,
+                                        self.goal or "enrolled",
+                                        self.day, self.count)
+
+
+class RollupMark(models.Model):
+    """High-water mark of the ReportRollup table: every Enrollment and
+    GoalRecord created up to and including mark has been counted."""
+
+    mark = models.DateTimeField()
+
+    def __unicode__(self):
+        return u"rollups complete up to %s" % self.mark
+
+
+class Archive(models.Model):
+    """A file of enrollments and goal records moved out of the database by
+    splango_archive, and not yet restored. The rollups counted every row
+    in it before it was archived."""
+
+    name = models.CharField(max_length=255, unique=True)
+    counted_to = models.DateTimeField()
+    enrollments = models.PositiveIntegerField(default=0)
+    goalrecords = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u"%s: %d enrollments, %d goal records" % (
+            self.name, self.enrollments, self.goalrecords)
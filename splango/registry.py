@@ -0,0 +1,59 @@
+"""Process-local registry of experiment definitions.
+
+Declaring an experiment that this process already knows about is a dict
+lookup instead of a get_or_create. Entries expire after
+settings.SPLANGO_EXPERIMENT_CACHE_TTL seconds (default 60, 0 disables the
+registry) and are dropped as soon as an Experiment is saved or deleted in
+this process; the TTL bounds how stale other processes can get.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_TTL = 60
+
+
+class ExperimentRegistry(object):
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_ttl(self):
+        return getattr(settings, "SPLANGO_EXPERIMENT_CACHE_TTL", DEFAULT_TTL)
+
+    def get(self, name):
+        """Return the cached Experiment called name, or None if it is
+        unknown or has expired."""
+        entry = self._entries.get(name)
+
+        if entry is None:
+            return None
+
+        exp, expires = entry
+
+        if expires < time.time():
+            self.invalidate(name)
+            return None
+
+        return exp
+
+    def put(self, exp):
+        ttl = self.get_ttl()
+
+        if ttl > 0:
+            with self._lock:
+                self._entries[exp.name] = (exp, time.time() + ttl)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+experiment_registry = ExperimentRegistry()
@@ -0,0 +1,237 @@
+"""Incremental maintenance of the ReportRollup table.
+
+A subject counts towards (experiment, variant, goal) once it has both the
+enrollment and the goal record, whichever came first. Each run therefore
+counts the (enrollment, goal record) pairs whose later half was created
+after the previous high-water mark, so every pair is counted exactly once.
+The pair is bucketed by the day of the goal record; enrollments are also
+counted on their own, bucketed by the day of the enrollment.
+
+Rollups only ever grow: rows later moved or deleted by Subject.merge_into
+are not subtracted. Run with rebuild=True to recount from scratch, which
+is refused while rows archived by splango.archive are out of the database.
+
+Rows imported from event files keep the time the event happened, which
+may be before the high-water mark. import_events() counts those itself,
+since update_rollups() never looks behind the mark.
+"""
+
+import datetime
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from splango.models import (Archive, Enrollment, GoalRecord, ReportRollup,
+                            RollupMark)
+from splango.writer import (EVENT_ENROLL, EVENT_GOAL, write_events,
+                            _experiment_ids)
+
+# subjects looked up per query when matching enrollments to goal records
+CHUNK_SIZE = 500
+
+
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _day(dt):
+    return dt.date()
+
+
+def _count_pairs(enrollments, goalrecords, goals_until, enrollments_until):
+    """Return {(experiment_id, variant, goal, day): count} for newly
+    countable rows: enrollments, as (subject_id, experiment_id, variant,
+    created), are counted and paired with their subjects' goal records
+    created up to goals_until; goalrecords, as (subject_id, goal, created),
+    are paired with their subjects' other enrollments created up to
+    enrollments_until, or with none if that's None."""
+
+    counts = {}
+
+    def add(key):
+        counts[key] = counts.get(key, 0) + 1
+
+    # new enrollments, and their pairs with any goal record so far
+
+    enrolled = {}
+
+    for (sid, exp_id, variant, created) in enrollments:
+        add((exp_id, variant, ReportRollup.ENROLLED, _day(created)))
+        enrolled.setdefault(sid, []).append((exp_id, variant))
+
+    for sids in _chunks(list(enrolled), CHUNK_SIZE):
+        for (sid, goal, created) in GoalRecord.objects.filter(
+            subject__in=sids, created__lte=goals_until).values_list(
+            "subject_id", "goal__name", "created"):
+            for (exp_id, variant) in enrolled[sid]:
+                add((exp_id, variant, goal, _day(created)))
+
+    # new goal records paired with older enrollments; pairs with the new
+    # enrollments were counted above
+
+    achieved = {}
+
+    for (sid, goal, created) in goalrecords:
+        achieved.setdefault(sid, []).append((goal, _day(created)))
+
+    if enrollments_until is not None:
+        for sids in _chunks(list(achieved), CHUNK_SIZE):
+            for (sid, exp_id, variant) in Enrollment.objects.filter(
+                subject__in=sids, created__lte=enrollments_until).values_list(
+                "subject_id", "experiment_id", "variant"):
+                if (exp_id, variant) in enrolled.get(sid, ()):
+                    continue
+
+                for (goal, day) in achieved[sid]:
+                    add((exp_id, variant, goal, day))
+
+    return counts
+
+
+def count_window(start, end):
+    """Return {(experiment_id, variant, goal, day): count} for everything
+    that became countable in the window (start, end]. start may be None
+    to count from the beginning of time."""
+
+    new_enrollments = Enrollment.objects.filter(created__lte=end)
+    new_goalrecords = GoalRecord.objects.filter(created__lte=end)
+
+    if start is not None:
+        new_enrollments = new_enrollments.filter(created__gt=start)
+        new_goalrecords = new_goalrecords.filter(created__gt=start)
+
+    return _count_pairs(
+        new_enrollments.values_list("subject_id", "experiment_id", "variant",
+                                    "created").iterator(),
+        new_goalrecords.values_list("subject_id", "goal__name",
+                                    "created").iterator(),
+        end, start)
+
+
+def apply_counts(counts):
+    for (exp_id, variant, goal, day), n in counts.items():
+        updated = ReportRollup.objects.filter(
+            experiment=exp_id, variant=variant, goal=goal, day=day
+            ).update(count=F("count") + n)
+
+        if not updated:
+            ReportRollup.objects.create(experiment_id=exp_id, variant=variant,
+                                        goal=goal, day=day, count=n)
+
+
+@transaction.commit_on_success
+def update_rollups(lag=60, rebuild=False):
+    """Bring ReportRollup up to date with rows created until lag seconds
+    ago (leaving time for in-flight transactions to commit). Returns the
+    new high-water mark."""
+
+    end = timezone.now() - datetime.timedelta(seconds=lag)
+
+    marks = list(RollupMark.objects.select_for_update().order_by("id")[:1])
+    mark = marks[0] if marks else None
+
+    if rebuild:
+        if Archive.objects.exists():
+            raise RuntimeError(
+                "Can't rebuild the rollups while archived rows are out of "
+                "the database; restore these archives first: %s"
+                % ", ".join(Archive.objects.values_list("name", flat=True)))
+
+        ReportRollup.objects.all().delete()
+        start = None
+    else:
+        start = mark and mark.mark
+
+    if start is not None and start >= end:
+        return start
+
+    apply_counts(count_window(start, end))
+
+    if mark is None:
+        mark = RollupMark()
+
+    mark.mark = end
+    mark.save()
+
+    return end
+
+
+def _new_rows(events, mark, counted_to=None):
+    """The enrollments and goal records events would add to the database
+    with a time at or before mark, and after counted_to if given:
+    ({(subject_id, exp_id): (variant, created)}, {(subject_id, goal_name):
+    created}). As in splango.writer, the first event for each row wins."""
+
+    enrollments = {}
+    goalrecords = {}
+    exp_ids = _experiment_ids(set(e[2] for e in events if e[0] == EVENT_ENROLL))
+
+    for event in events:
+        created = event[-1]
+
+        if event[0] == EVENT_ENROLL and event[2] in exp_ids:
+            key = (event[1], exp_ids[event[2]])
+
+            if key not in enrollments:
+                enrollments[key] = (event[3], created)
+
+        elif event[0] == EVENT_GOAL:
+            goalrecords.setdefault((event[1], event[2]), created)
+
+    if enrollments:
+        for key in Enrollment.objects.filter(
+            subject__in=set(sid for (sid, exp_id) in enrollments),
+            experiment__in=set(exp_ids.values())).values_list(
+            "subject_id", "experiment_id"):
+            enrollments.pop(key, None)
+
+    if goalrecords:
+        for key in GoalRecord.objects.filter(
+            subject__in=set(sid for (sid, goal) in goalrecords),
+            goal__name__in=set(goal for (sid, goal) in goalrecords)).values_list(
+            "subject_id", "goal__name"):
+            goalrecords.pop(key, None)
+
+    def late(created):
+        return created <= mark and (counted_to is None or created > counted_to)
+
+    return (dict((k, v) for (k, v) in enrollments.items() if late(v[1])),
+            dict((k, v) for (k, v) in goalrecords.items() if late(v)))
+
+
+def count_late(enrollments, goalrecords, mark):
+    """Return the counts to add for enrollments and goal records, as
+    returned by _new_rows, that were written after the rollups had passed
+    mark. Pairs with rows created after mark are left to the next
+    update_rollups()."""
+
+    return _count_pairs(
+        [ (sid, exp_id, variant, created)
+          for (sid, exp_id), (variant, created) in enrollments.items() ],
+        [ (sid, goal, created)
+          for (sid, goal), created in goalrecords.items() ],
+        mark, mark)
+
+
+@transaction.commit_on_success
+def import_events(events, counted_to=None):
+    """Write events that end with the time they happened, as
+    splango.sinks.read_events returns them, and count the new rows that
+    the rollups have already passed by. Rows from an archive were counted
+    up to its counted_to before they were archived, so aren't counted
+    again."""
+
+    # hold the mark so update_rollups() can't move it meanwhile
+    marks = list(RollupMark.objects.select_for_update().order_by("id")[:1])
+    mark = marks[0].mark if marks else None
+
+    if mark is not None:
+        enrollments, goalrecords = _new_rows(events, mark, counted_to)
+
+    write_events(events)
+
+    if mark is not None and (enrollments or goalrecords):
+        apply_counts(count_late(enrollments, goalrecords, mark))
+
@@ -0,0 +1,169 @@
+"""Significance statistics for experiment reports.
+
+Everything here works from counts alone (how many subjects reached a step,
+out of how many that could have), so reports get these figures for the
+cost of a little arithmetic on numbers they already have. The first
+variant of an experiment is taken as the control.
+
+  wilson_interval   confidence interval for a conversion rate
+  z_test            two-proportion z-test of a variant against the control
+  chi_square_test   chi-square test of independence across all variants
+  prob_beats        Bayesian probability that a variant's true rate is
+                    higher than the control's, with uniform priors
+"""
+
+import math
+
+# two-sided 95%
+Z_95 = 1.959964
+
+# beyond this many successes and failures, prob_beats uses a normal
+# approximation of the beta posteriors rather than the exact sum
+EXACT_LIMIT = 1000
+
+
+def normal_cdf(x):
+    return 0.5 * (1.0 + math.erf(x / math.sqrt(2.0)))
+
+
+def wilson_interval(successes, trials, z=Z_95):
+    """(low, high) bounds of the Wilson score interval, or (None, None)
+    without trials. Successes beyond the trials count as a rate of 1."""
+
+    if not trials:
+        return None, None
+
+    p = min(1.0, max(0.0, float(successes) / trials))
+    z2 = z * z
+    center = p + z2 / (2 * trials)
+    spread = z * math.sqrt(p * (1 - p) / trials + z2 / (4 * trials * trials))
+    denom = 1 + z2 / trials
+
+    return (max(0.0, (center - spread) / denom),
+            min(1.0, (center + spread) / denom))
+
+
+def z_test(s1, n1, s2, n2):
+    """Pooled two-proportion z-test of s2/n2 against s1/n1. Returns
+    (z, two-sided p-value), or (None, None) if it isn't defined."""
+
+    if not n1 or not n2:
+        return None, None
+
+    pooled = float(s1 + s2) / (n1 + n2)
+    se = math.sqrt(pooled * (1 - pooled) * (1.0 / n1 + 1.0 / n2))
+
+    if se == 0:
+        return None, None
+
+    z = (float(s2) / n2 - float(s1) / n1) / se
+
+    return z, 2 * (1 - normal_cdf(abs(z)))
+
+
+def _gamma_q(a, x):
+    """Regularized upper incomplete gamma function Q(a, x), by series or
+    continued fraction as in Numerical Recipes."""
+
+    if x <= 0:
+        return 1.0
+
+    log_front = -x + a * math.log(x) - math.lgamma(a)
+
+    if x < a + 1:
+        term = total = 1.0 / a
+        ap = a
+
+        for i in range(1000):
+            ap += 1
+            term *= x / ap
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+
+        return 1.0 - total * math.exp(log_front)
+
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        if abs(d) < tiny:
+            d = tiny
+        c = b + an / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+
+    return math.exp(log_front) * h
+
+
+def chi_square_test(successes, trials):
+    """Chi-square test that the conversion rate is the same for every
+    variant, given per-variant lists of successes and trials. Returns
+    (statistic, p-value), or (None, None) if it isn't defined."""
+
+    cells = [ (s, n) for (s, n) in zip(successes, trials) if n ]
+
+    if len(cells) < 2:
+        return None, None
+
+    total_s = sum(s for (s, n) in cells)
+    total_n = sum(n for (s, n) in cells)
+
+    if total_s == 0 or total_s == total_n:
+        return None, None
+
+    rate = float(total_s) / total_n
+    statistic = 0.0
+
+    for s, n in cells:
+        expect_s = n * rate
+        expect_f = n - expect_s
+        statistic += ((s - expect_s) ** 2 / expect_s
+                      + ((n - s) - expect_f) ** 2 / expect_f)
+
+    return statistic, _gamma_q((len(cells) - 1) / 2.0, statistic / 2.0)
+
+
+def _log_beta(a, b):
+    return math.lgamma(a) + math.lgamma(b) - math.lgamma(a + b)
+
+
+def prob_beats(s1, n1, s2, n2):
+    """Probability that the rate behind s2/n2 exceeds the one behind s1/n1,
+    each with a Beta(1, 1) prior."""
+
+    a1, b1 = s1 + 1, n1 - s1 + 1
+    a2, b2 = s2 + 1, n2 - s2 + 1
+
+    if min(a2, b2, a1, b1) > EXACT_LIMIT:
+        mean1 = float(a1) / (a1 + b1)
+        mean2 = float(a2) / (a2 + b2)
+        var1 = a1 * b1 / float((a1 + b1) ** 2 * (a1 + b1 + 1))
+        var2 = a2 * b2 / float((a2 + b2) ** 2 * (a2 + b2 + 1))
+        return normal_cdf((mean2 - mean1) / math.sqrt(var1 + var2))
+
+    # exact closed form, summing over whichever parameter is smaller
+    if a2 <= b1:
+        return sum(math.exp(_log_beta(a1 + i, b1 + b2)
+                            - math.log(b2 + i)
+                            - _log_beta(1 + i, b2)
+                            - _log_beta(a1, b1))
+                   for i in range(a2))
+
+    # the same, for the failure rates: 1 - p1 beats 1 - p2
+    return sum(math.exp(_log_beta(b2 + i, a1 + a2)
+                        - math.log(a1 + i)
+                        - _log_beta(1 + i, a1)
+                        - _log_beta(b2, a2))
+               for i in range(b1))
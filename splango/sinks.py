@@ -0,0 +1,188 @@
+"""Where RequestExperimentManager sends enrollments and goal records.
+
+settings.SPLANGO_EVENT_SINK names the sink class by dotted path. The
+default is DatabaseSink, which writes through the ORM as it happens. With
+SPLANGO_WRITE_BEHIND it is WriteBehindSink instead; see splango.writer.
+
+FileSink appends events to newline-delimited JSON files and never touches
+the database. `manage.py splango_import_events` loads those files into the
+relational tables later, with duplicates removed and each event's
+original time kept.
+
+A sink only sees enrollments that go through the queue: those of
+visitors not yet confirmed as human, and all of them with
+SPLANGO_ASSIGNMENT = "hash". Random assignment for known humans still reads
+and writes Enrollment directly.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from splango import writer
+from splango.loading import load_from_setting
+from splango.models import Experiment, GoalRecord
+
+
+class EventSink(object):
+
+    def enroll(self, subject, exp_name, variant):
+        """Record that subject sees variant of the named experiment, and
+        return the variant the subject is known to be enrolled in, which
+        may differ if it was enrolled before."""
+        raise NotImplementedError
+
+    def record_goal(self, subject, goal_name, request_info, extra=None):
+        """Record that subject reached the named goal."""
+        raise NotImplementedError
+
+    def enroll_many(self, subject, enrollments):
+        """Enroll subject according to a list of (exp_name, variant) pairs
+        and return {exp_name: variant} as for enroll()."""
+        return dict((exp_name, self.enroll(subject, exp_name, variant))
+                    for (exp_name, variant) in enrollments)
+
+    def record_goals(self, subject, goals):
+        """Record a list of (goal_name, request_info, extra) for subject."""
+        for (goal_name, request_info, extra) in goals:
+            self.record_goal(subject, goal_name, request_info, extra)
+
+
+class DatabaseSink(EventSink):
+
+    def enroll(self, subject, exp_name, variant):
+        exp = Experiment.objects.get(name=exp_name)
+        return exp.enroll_subject_as_variant(subject, variant).variant
+
+    def record_goal(self, subject, goal_name, request_info, extra=None):
+        GoalRecord.record(subject, goal_name, request_info, extra=extra)
+
+    def enroll_many(self, subject, enrollments):
+        existing = writer.write_enrollments(
+            [ (subject.id, exp_name, variant)
+              for (exp_name, variant) in enrollments ])
+
+        return dict((exp_name, existing.get((subject.id, exp_name), variant))
+                    for (exp_name, variant) in enrollments)
+
+    def record_goals(self, subject, goals):
+        writer.write_goals([ (subject.id, goal_name, request_info, extra)
+                             for (goal_name, request_info, extra) in goals ])
+
+
+class WriteBehindSink(EventSink):
+
+    def enroll(self, subject, exp_name, variant):
+        writer.get_writer().enqueue_enrollment(subject.id, exp_name, variant)
+        return variant
+
+    def record_goal(self, subject, goal_name, request_info, extra=None):
+        writer.get_writer().enqueue_goal(subject.id, goal_name, request_info,
+                                         extra)
+
+
+class FileSink(EventSink):
+    """Appends one JSON array per event to files in
+    settings.SPLANGO_EVENT_LOG_DIR, a new file per process and per period
+    of settings.SPLANGO_EVENT_LOG_ROTATE (an strftime format, hourly by
+    default). Each line is a splango.writer event tuple with the event's
+    time appended, in UTC with its offset."""
+
+    def __init__(self):
+        self.directory = getattr(settings, "SPLANGO_EVENT_LOG_DIR", None)
+
+        if not self.directory:
+            raise ImproperlyConfigured("FileSink requires settings.SPLANGO_EVENT_LOG_DIR.")
+
+        self.rotate = getattr(settings, "SPLANGO_EVENT_LOG_ROTATE", "%Y%m%d%H")
+        self._lock = threading.Lock()
+        self._path = None
+        self._file = None
+
+    def path_for(self, now):
+        return os.path.join(self.directory, "events-%s-%d.ndjson"
+                            % (now.strftime(self.rotate), os.getpid()))
+
+    def write(self, event):
+        now = datetime.datetime.utcnow()
+        line = event_line(event, timezone.now())
+        path = self.path_for(now)
+
+        with self._lock:
+            if path != self._path:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(path, "a")
+                self._path = path
+
+            self._file.write(line)
+            self._file.flush()
+
+    def enroll(self, subject, exp_name, variant):
+        self.write((writer.EVENT_ENROLL, subject.id, exp_name, variant))
+        return variant
+
+    def record_goal(self, subject, goal_name, request_info, extra=None):
+        self.write((writer.EVENT_GOAL, subject.id, goal_name, request_info,
+                    extra))
+
+
+def format_when(when):
+    """Turn a datetime as the database stores it into UTC ISO 8601 text."""
+
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.get_default_timezone())
+
+    return when.astimezone(timezone.utc).isoformat()
+
+
+def event_line(event, when):
+    """The line for a splango.writer event tuple that happened at when, a
+    datetime as the database stores it."""
+    return json.dumps(list(event) + [format_when(when)]) + "\n"
+
+
+def parse_when(value):
+    """Turn the time at the end of a FileSink line into a datetime as the
+    database stores it."""
+
+    when = parse_datetime(value)
+
+    if timezone.is_naive(when):
+        # written before times carried their offset, in UTC
+        when = timezone.make_aware(when, timezone.utc)
+
+    if not settings.USE_TZ:
+        when = timezone.make_naive(when, timezone.get_default_timezone())
+
+    return when
+
+
+def read_events(lines):
+    """Turn FileSink lines back into splango.writer event tuples, each with
+    the time it happened as its last item. Lines holding an object rather
+    than an event, such as an archive's header, are skipped."""
+    for line in lines:
+        line = line.strip()
+
+        if line:
+            event = json.loads(line)
+
+            if isinstance(event, list):
+                yield tuple(event[:-1]) + (parse_when(event[-1]),)
+
+
+def get_sink():
+    """Return the configured EventSink, one instance per class."""
+    if writer.is_enabled():
+        default = "splango.sinks.WriteBehindSink"
+    else:
+        default = "splango.sinks.DatabaseSink"
+
+    return load_from_setting("SPLANGO_EVENT_SINK", default)
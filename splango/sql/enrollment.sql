@@ -0,0 +1,3 @@
+-- Reports count enrollments per variant of an experiment, and the
+-- experiment log reads one variant's enrollments in created order.
+CREATE INDEX splango_enrollment_exp_variant_created ON splango_enrollment (experiment_id, variant, created);
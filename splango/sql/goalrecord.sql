@@ -0,0 +1,4 @@
+-- The experiment log reads one goal's records in created order; reports
+-- and rollups match them to enrollments through (subject_id, goal_id),
+-- which the unique constraint already indexes.
+CREATE INDEX splango_goalrecord_goal_created ON splango_goalrecord (goal_id, created);
@@ -0,0 +1,72 @@
+-- Upgrades a PostgreSQL database from name-keyed goals and experiments to
+-- integer keys, keeping the names as unique columns. Run it once, with
+-- the site stopped:
+--
+--   psql yourdb -f upgrade_integer_keys.postgresql.sql
+--
+-- Then run syncdb, which creates the tables this version adds. (syncdb
+-- doesn't run this file; it only runs files named after models.)
+
+BEGIN;
+
+-- goals
+
+ALTER TABLE splango_goal DROP CONSTRAINT splango_goal_pkey CASCADE;
+ALTER TABLE splango_goal ADD COLUMN id serial PRIMARY KEY;
+ALTER TABLE splango_goal ADD CONSTRAINT splango_goal_name_key UNIQUE (name);
+
+ALTER TABLE splango_goalrecord RENAME COLUMN goal_id TO goal_name;
+ALTER TABLE splango_goalrecord ADD COLUMN goal_id integer;
+UPDATE splango_goalrecord r SET goal_id = g.id FROM splango_goal g WHERE g.name = r.goal_name;
+ALTER TABLE splango_goalrecord ALTER COLUMN goal_id SET NOT NULL;
+ALTER TABLE splango_goalrecord DROP COLUMN goal_name;
+ALTER TABLE splango_goalrecord ADD CONSTRAINT splango_goalrecord_subject_id_goal_id_key UNIQUE (subject_id, goal_id);
+ALTER TABLE splango_goalrecord ADD CONSTRAINT splango_goalrecord_goal_id_fkey FOREIGN KEY (goal_id) REFERENCES splango_goal (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX splango_goalrecord_goal_id ON splango_goalrecord (goal_id);
+CREATE INDEX splango_goalrecord_goal_created ON splango_goalrecord (goal_id, created);
+
+-- experiments
+
+ALTER TABLE splango_experiment DROP CONSTRAINT splango_experiment_pkey CASCADE;
+ALTER TABLE splango_experiment ADD COLUMN id serial PRIMARY KEY;
+ALTER TABLE splango_experiment ADD CONSTRAINT splango_experiment_name_key UNIQUE (name);
+
+ALTER TABLE splango_enrollment RENAME COLUMN experiment_id TO experiment_name;
+ALTER TABLE splango_enrollment ADD COLUMN experiment_id integer;
+UPDATE splango_enrollment e SET experiment_id = x.id FROM splango_experiment x WHERE x.name = e.experiment_name;
+ALTER TABLE splango_enrollment ALTER COLUMN experiment_id SET NOT NULL;
+ALTER TABLE splango_enrollment DROP COLUMN experiment_name;
+ALTER TABLE splango_enrollment ADD CONSTRAINT splango_enrollment_subject_id_experiment_id_key UNIQUE (subject_id, experiment_id);
+ALTER TABLE splango_enrollment ADD CONSTRAINT splango_enrollment_experiment_id_fkey FOREIGN KEY (experiment_id) REFERENCES splango_experiment (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX splango_enrollment_experiment_id ON splango_enrollment (experiment_id);
+CREATE INDEX splango_enrollment_exp_variant_created ON splango_enrollment (experiment_id, variant, created);
+
+ALTER TABLE splango_experimentreport RENAME COLUMN experiment_id TO experiment_name;
+ALTER TABLE splango_experimentreport ADD COLUMN experiment_id integer;
+UPDATE splango_experimentreport r SET experiment_id = x.id FROM splango_experiment x WHERE x.name = r.experiment_name;
+ALTER TABLE splango_experimentreport ALTER COLUMN experiment_id SET NOT NULL;
+ALTER TABLE splango_experimentreport DROP COLUMN experiment_name;
+ALTER TABLE splango_experimentreport ADD CONSTRAINT splango_experimentreport_experiment_id_fkey FOREIGN KEY (experiment_id) REFERENCES splango_experiment (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX splango_experimentreport_experiment_id ON splango_experimentreport (experiment_id);
+
+-- splango_reportrollup only exists on installs that already ran a
+-- version with rollups; syncdb creates it with integer keys otherwise.
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.tables
+               WHERE table_schema = current_schema()
+                 AND table_name = 'splango_reportrollup') THEN
+        EXECUTE 'ALTER TABLE splango_reportrollup RENAME COLUMN experiment_id TO experiment_name';
+        EXECUTE 'ALTER TABLE splango_reportrollup ADD COLUMN experiment_id integer';
+        EXECUTE 'UPDATE splango_reportrollup r SET experiment_id = x.id FROM splango_experiment x WHERE x.name = r.experiment_name';
+        EXECUTE 'ALTER TABLE splango_reportrollup ALTER COLUMN experiment_id SET NOT NULL';
+        EXECUTE 'ALTER TABLE splango_reportrollup DROP COLUMN experiment_name';
+        EXECUTE 'ALTER TABLE splango_reportrollup ADD CONSTRAINT splango_reportrollup_experiment_id_variant_goal_day_key UNIQUE (experiment_id, variant, goal, day)';
+        EXECUTE 'ALTER TABLE splango_reportrollup ADD CONSTRAINT splango_reportrollup_experiment_id_fkey FOREIGN KEY (experiment_id) REFERENCES splango_experiment (id) DEFERRABLE INITIALLY DEFERRED';
+        EXECUTE 'CREATE INDEX splango_reportrollup_experiment_id ON splango_reportrollup (experiment_id)';
+    END IF;
+END
+$$;
+
+COMMIT;
@@ -0,0 +1,134 @@
+"""Timing and query counts for Splango's per-request work.
+
+RequestExperimentManager times declare_and_enroll, log_goal, confirm_human,
+finish and subject merges, and counts the database queries each one runs
+(query counts need settings.DEBUG, since that's when Django keeps them).
+Each measurement goes to the backend named by settings.SPLANGO_STATS_BACKEND:
+
+  splango.stats.StatsdBackend  sends statsd timers and counters over UDP to
+                               SPLANGO_STATSD_HOST:SPLANGO_STATSD_PORT
+                               (localhost:8125), prefixed with
+                               SPLANGO_STATSD_PREFIX ("splango")
+  splango.stats.LocalBackend   keeps them in memory; handy in tests
+
+With settings.DEBUG, responses also get an X-Splango-Overhead header
+summarizing the request's Splango operations.
+"""
+
+import socket
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+from splango.loading import load_from_setting
+
+HEADER = "X-Splango-Overhead"
+
+
+class StatsBackend(object):
+
+    def timing(self, name, ms):
+        raise NotImplementedError
+
+    def incr(self, name, n=1):
+        raise NotImplementedError
+
+
+class LocalBackend(StatsBackend):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+
+    def timing(self, name, ms):
+        self.timings.setdefault(name, []).append(ms)
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+class StatsdBackend(StatsBackend):
+
+    def __init__(self):
+        self.address = (getattr(settings, "SPLANGO_STATSD_HOST", "localhost"),
+                        getattr(settings, "SPLANGO_STATSD_PORT", 8125))
+        self.prefix = getattr(settings, "SPLANGO_STATSD_PREFIX", "splango")
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass # stats are best effort
+
+    def timing(self, name, ms):
+        self.send("%s.%s:%d|ms" % (self.prefix, name, ms))
+
+    def incr(self, name, n=1):
+        self.send("%s.%s:%d|c" % (self.prefix, name, n))
+
+
+def get_backend():
+    """Return the configured StatsBackend, or None."""
+    return load_from_setting("SPLANGO_STATS_BACKEND")
+
+
+class RequestStats(object):
+    """Per-request totals of each operation's calls, time and queries."""
+
+    def __init__(self):
+        self.ops = {}
+
+    @contextmanager
+    def measure(self, name):
+        count_queries = settings.DEBUG
+        queries_before = len(connection.queries) if count_queries else 0
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            ms = 1000 * (time.time() - start)
+            queries = len(connection.queries) - queries_before if count_queries else 0
+            self.record(name, ms, queries)
+
+    def record(self, name, ms, queries=0):
+        op = self.ops.setdefault(name, [0, 0.0, 0])
+        op[0] += 1
+        op[1] += ms
+        op[2] += queries
+
+        backend = get_backend()
+
+        if backend is not None:
+            backend.timing(name, ms)
+
+            if queries:
+                backend.incr("%s.queries" % name, queries)
+
+    def summary(self):
+        """e.g. 'declare_and_enroll=2/0.41ms/1q, finish=1/1.20ms/2q'"""
+        return ", ".join("%s=%d/%.2fms/%dq" % (name, count, ms, queries)
+                         for name, (count, ms, queries)
+                         in sorted(self.ops.items()))
+
+
+def instrumented(name):
+    """Decorate a RequestExperimentManager method to be measured as name."""
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.measure(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
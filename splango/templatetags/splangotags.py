@@ -45,11 +45,9 @@ class HypNode(template.Node):
 #                                                   self.exp_variant)
 
         ctxvar = CTX_PREFIX + self.exp_name
+        variant = _declared_variant(context, self.exp_name, "hyp")
 
-        if ctxvar not in context:
-            raise template.TemplateSyntaxError("Experiment %s has not yet been declared. Please declare it and supply variant names using an experiment tag before using hyp tags.")
-
-        if self.exp_variant == context[ctxvar]:
+        if self.exp_variant == variant:
             return self.nodelist.render(context)
         else:
             return ""
@@ -84,9 +82,6 @@ def hyp(parser, token):
     #print "parser.tokens = %r" % [ t.contents for t in parser.tokens ]
 
     nodelist = parser.parse(("endhyp",))
-    token = parser.next_token()
-
-#     print " * hyp FOUND TOKEN %s" % token.contents
     parser.delete_first_token()
     #print "parser.tokens = %r" % [ t.contents for t in parser.tokens ]
 
@@ -94,22 +89,121 @@ def hyp(parser, token):
     return HypNode(exp_name.strip("\"'"), exp_variant.strip("\"'"), nodelist)
 
 
-# I couldn't make this work well. Probably needs much more thought to work like
-# a switch statement. See:
-# http://djangosnippets.org/snippets/967/
-#
-# @register.tag
-# def elsehyp(parser, token):
-#     try:
-#         tag_name, exp_variant = token.split_contents()
-#     except ValueError:
-#         raise template.TemplateSyntaxError, "%r tag requires exactly one argument" % token.contents.split()[0]
+def _declared_variant(context, exp_name, tag_name):
+    ctxvar = CTX_PREFIX + exp_name
 
-#     #import pdb;pdb.set_trace()
+    if ctxvar in context:
+        return context[ctxvar]
 
-#     print "*** elsehyp looking for next tag"
-#     #print "parser.tokens = %r" % [ t.contents for t in parser.tokens ]
-    
-#     nodelist = parser.parse(("elsehyp","endhyp"))
-   
-#     return HypNode(None, exp_variant, nodelist)
+    # declared elsewhere in this request: in a view, or in another template
+    request = context.get("request")
+    exp = getattr(request, "experiments", None)
+    variant = exp.declared_variant(exp_name) if exp else None
+
+    if variant is None:
+        raise template.TemplateSyntaxError("Experiment %s has not yet been declared. Please declare it and supply variant names using an experiment tag before using %s tags." % (exp_name, tag_name))
+
+    return variant
+
+
+class HypSwitchNode(template.Node):
+    """Renders only the branch for the experiment's variant, looked up once,
+    or the default branch if no case matches."""
+
+    def __init__(self, exp_name, cases, default):
+        self.exp_name = exp_name
+        self.cases = cases # variant name -> nodelist
+        self.default = default
+
+    def get_nodes_by_type(self, nodetype):
+        nodes = []
+        if isinstance(self, nodetype):
+            nodes.append(self)
+        for nodelist in self.cases.values():
+            nodes.extend(nodelist.get_nodes_by_type(nodetype))
+        if self.default is not None:
+            nodes.extend(self.default.get_nodes_by_type(nodetype))
+        return nodes
+
+    def render(self, context):
+        variant = _declared_variant(context, self.exp_name, "hypswitch")
+        nodelist = self.cases.get(variant, self.default)
+
+        if nodelist is None:
+            return ""
+
+        return nodelist.render(context)
+
+
+@register.tag
+def hypswitch(parser, token):
+    """
+    {% hypswitch "signuptext" %}
+      {% case "control" %}sign up
+      {% case "free" "trial" %}try it
+      {% default %}sign up now
+    {% endhypswitch %}
+
+    Anything between hypswitch and the first case is ignored. A case may
+    list several variants; default is optional.
+    """
+    try:
+        tag_name, exp_name = token.split_contents()
+    except ValueError:
+        raise template.TemplateSyntaxError("%r tag requires exactly one argument" % token.contents.split()[0])
+
+    cases = {}
+    default = None
+
+    parser.parse(("case", "default", "endhypswitch"))
+    token = parser.next_token()
+
+    while token.contents != "endhypswitch":
+        bits = token.split_contents()
+        nodelist = parser.parse(("case", "default", "endhypswitch"))
+
+        if bits[0] == "default":
+            if default is not None:
+                raise template.TemplateSyntaxError("hypswitch allows only one default")
+            default = nodelist
+
+        else:
+            if len(bits) < 2:
+                raise template.TemplateSyntaxError("case tag requires at least one variant name")
+            for v in bits[1:]:
+                cases.setdefault(v.strip("\"'"), nodelist)
+
+        token = parser.next_token()
+
+    return HypSwitchNode(exp_name.strip("\"'"), cases, default)
+
+
+class HypVariantNode(template.Node):
+    def __init__(self, exp_name, var_name):
+        self.exp_name = exp_name
+        self.var_name = var_name
+
+    def render(self, context):
+        context[self.var_name] = _declared_variant(context, self.exp_name,
+                                                   "hypvariant")
+        return ""
+
+
+@register.tag
+def hypvariant(parser, token):
+    """
+    {% hypvariant "signuptext" as variant %}
+
+    Puts the visitor's variant of a declared experiment into a context
+    variable, e.g. to key a fragment cache by it:
+    {% cache 600 signupbox variant %}...{% endcache %}
+    """
+    try:
+        tag_name, exp_name, as_label, var_name = token.split_contents()
+    except ValueError:
+        raise template.TemplateSyntaxError("%r tag requires the form {%% hypvariant \"exp\" as var %%}" % token.contents.split()[0])
+
+    if as_label != "as":
+        raise template.TemplateSyntaxError("%r tag's second argument must be 'as'" % tag_name)
+
+    return HypVariantNode(exp_name.strip("\"'"), var_name)
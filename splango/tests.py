@@ -5,7 +5,41 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import datetime
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.template import Context, Template, TemplateSyntaxError
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import splango
+from splango import (NullExperimentManager, RequestExperimentManager,
+                     SPLANGO_QUEUED_UPDATES, coalesce_actions)
+from splango import activity, archive, bandit, benchmark, export, loading, significance, views
+from splango.bandit import BanditSnapshot
+from splango.assignment import choose_weighted, hashed_variant
+from splango.cache import cache_per_variant, variant_cache_key
+from splango.injection import inject_before_body_end, inject_into_response
+from splango.middleware import ExperimentsMiddleware
+from splango.models import Enrollment, Experiment, ExperimentReport, Goal, GoalRecord, Subject
+from splango.registry import experiment_registry
+from splango.rollup import update_rollups
+from splango.sinks import FileSink, event_line
+from splango.stats import HEADER, get_backend
+from splango import writer
+from splango.writer import EventWriter, WHEN_FULL_DROP, WHEN_FULL_SYNC
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +55,1175 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+def make_request(path="/", **extra):
+    request = RequestFactory().get(path, **extra)
+    request.session = SessionStore()
+    request.user = AnonymousUser()
+    return request
+
+
+class SplangoTestCase(TestCase):
+    def setUp(self):
+        # cached experiments would outlive each test's rolled-back rows
+        experiment_registry.clear()
+
+
+class HashAssignmentTest(SplangoTestCase):
+    def test_same_key_same_variant(self):
+        variants = ["a", "b", "c"]
+        for key in ("k1", "k2", "k3"):
+            self.assertEqual(hashed_variant(key, "exp", variants),
+                             hashed_variant(key, "exp", variants))
+
+    def test_salt_changes_assignment(self):
+        variants = [str(i) for i in range(100)]
+        picks = [ hashed_variant("key%d" % i, "exp", variants, salt=s)
+                  for i in range(20) for s in ("", "pepper") ]
+        self.assertNotEqual(picks[0::2], picks[1::2])
+
+    def test_weights(self):
+        self.assertEqual(choose_weighted(["a", "b"], [1, 3], 0.2), "a")
+        self.assertEqual(choose_weighted(["a", "b"], [1, 3], 0.3), "b")
+        self.assertEqual(choose_weighted(["a", "b"], [0, 1], 0.0), "b")
+        self.assertRaises(ValueError, choose_weighted, ["a", "b"], [1], 0.5)
+
+    def test_declare_and_enroll_once(self):
+        with override_settings(SPLANGO_ASSIGNMENT="hash"):
+            request = make_request()
+            request.session[splango.SPLANGO_STATE] = splango.S_HUMAN
+            rem = RequestExperimentManager(request)
+
+            v = rem.declare_and_enroll("hashexp", ["a", "b"])
+            self.assertEqual(v, rem.declare_and_enroll("hashexp", ["a", "b"]))
+            self.assertEqual(len(rem.queued_actions), 1)
+
+            rem.finish(HttpResponse(content_type="text/plain"))
+            self.assertEqual(Enrollment.objects.get().variant, v)
+
+            rem = RequestExperimentManager(request)
+            self.assertEqual(rem.declare_and_enroll("hashexp", ["a", "b"]), v)
+            self.assertEqual(rem.queued_actions, [])
+
+    @override_settings(SPLANGO_ASSIGNMENT="hash")
+    def test_login_shows_stored_enrollments(self):
+        variants = ["a", "b", "c", "d"]
+        user = User.objects.create(username="hashed")
+        registered = Subject.objects.create(registered_as=user)
+
+        request = make_request()
+        request.session[splango.SPLANGO_STATE] = splango.S_HUMAN
+        rem = RequestExperimentManager(request)
+        hashed = rem.declare_and_enroll("seen", variants)
+        rem.finish(HttpResponse(content_type="text/plain"))
+
+        # the registered subject got other variants on another device
+        stored = [ v for v in variants if v != hashed ][0]
+        for name in ("seen", "unseen"):
+            Experiment.declare(name, variants).enroll_subject_as_variant(
+                registered, stored)
+
+        rem = RequestExperimentManager(request)
+        rem.state # loaded before logging in
+        request.user = user
+        rem.finish(HttpResponse(content_type="text/plain"))
+
+        rem = RequestExperimentManager(request)
+        with self.assertNumQueries(0):
+            self.assertEqual(rem.declare_and_enroll("seen", variants), stored)
+            self.assertEqual(rem.declare_and_enroll("unseen", variants), stored)
+
+
+class ExperimentRegistryTest(SplangoTestCase):
+    def test_declare_is_cached(self):
+        Experiment.declare("cached", ["a", "b"])
+        self.assertNumQueries(0, Experiment.declare, "cached", ["a", "b"])
+
+    def test_save_invalidates(self):
+        e = Experiment.declare("cached", ["a", "b"])
+        e.set_variants(["a", "b", "c"])
+        e.save()
+        self.assertEqual(Experiment.declare("cached", ["a", "b"]).get_variants(),
+                         ["a", "b", "c"])
+
+    @override_settings(SPLANGO_EXPERIMENT_CACHE_TTL=0)
+    def test_disabled(self):
+        Experiment.declare("cached", ["a", "b"])
+        self.assertNumQueries(1, Experiment.declare, "cached", ["a", "b"])
+
+
+class EventWriterTest(SplangoTestCase):
+    def setUp(self):
+        super(EventWriterTest, self).setUp()
+        self.sub = Subject.objects.create()
+        self.exp = Experiment.declare("written", ["a", "b"])
+
+    def test_flush_dedupes(self):
+        w = EventWriter(background=False)
+        w.enqueue_goal(self.sub.id, "signup", {"req_path": "/x"})
+        w.enqueue_goal(self.sub.id, "signup", {"req_path": "/y"}, extra="late")
+        w.enqueue_enrollment(self.sub.id, "written", "a")
+        w.enqueue_enrollment(self.sub.id, "written", "b")
+        w.flush()
+
+        gr = GoalRecord.objects.get()
+        self.assertEqual((gr.req_path, gr.extra), ("/x", "late"))
+        self.assertEqual(Enrollment.objects.get().variant, "a")
+
+    def test_existing_rows_win(self):
+        self.exp.enroll_subject_as_variant(self.sub, "b")
+        GoalRecord.record(self.sub, "signup", {})
+
+        w = EventWriter(background=False)
+        w.enqueue_enrollment(self.sub.id, "written", "a")
+        w.enqueue_goal(self.sub.id, "signup", {}, extra="more")
+        w.flush()
+
+        self.assertEqual(Enrollment.objects.get().variant, "b")
+        self.assertEqual(GoalRecord.objects.get().extra, "more")
+
+    def test_bad_event_only_drops_itself(self):
+        w = EventWriter(background=False)
+        w.enqueue_goal(self.sub.id, "signup", {"req_path": "/x"})
+        w.enqueue_goal(None, "broken", {}) # no subject
+        w.enqueue_enrollment(self.sub.id, "written", "a")
+        w.flush()
+
+        self.assertEqual(GoalRecord.objects.get().req_path, "/x")
+        self.assertEqual(Enrollment.objects.get().variant, "a")
+
+    def test_conflicting_insert_falls_back(self):
+        other = Subject.objects.create()
+        self.exp.enroll_subject_as_variant(self.sub, "b")
+
+        # as if another process inserted the first row after we checked
+        writer._bulk_insert(Enrollment,
+                            [ Enrollment(subject=self.sub, experiment=self.exp, variant="a"),
+                              Enrollment(subject=other, experiment=self.exp, variant="a") ],
+                            ("subject_id", "experiment_id"))
+
+        self.assertEqual(Enrollment.objects.get(subject=self.sub).variant, "b")
+        self.assertEqual(Enrollment.objects.get(subject=other).variant, "a")
+
+    def test_when_full(self):
+        w = EventWriter(queue_size=1, when_full=WHEN_FULL_DROP, background=False)
+        w.enqueue_goal(self.sub.id, "first", {})
+        w.enqueue_goal(self.sub.id, "dropped", {})
+        w.flush()
+        self.assertEqual(list(Goal.objects.values_list("name", flat=True)),
+                         ["first"])
+
+        w = EventWriter(queue_size=1, when_full=WHEN_FULL_SYNC, background=False)
+        w.enqueue_goal(self.sub.id, "queued", {})
+        w.enqueue_goal(self.sub.id, "inline", {})
+        self.assertTrue(GoalRecord.objects.filter(goal__name="inline").exists())
+
+
+class ExperimentReportTest(SplangoTestCase):
+    def setUp(self):
+        super(ExperimentReportTest, self).setUp()
+        self.exp = Experiment.declare("funnel", ["a", "b"])
+
+        for variant, goals in [("a", ["seen", "signup"]),
+                               ("a", ["seen"]),
+                               ("a", []),
+                               ("b", ["seen", "signup"])]:
+            sub = Subject.objects.create()
+            self.exp.enroll_subject_as_variant(sub, variant)
+            for g in goals:
+                GoalRecord.record(sub, g, {})
+
+        self.rept = ExperimentReport.objects.create(
+            experiment=self.exp, title="t", funnel="seen\nsignup\nmissing")
+
+    def test_generate(self):
+        with self.assertNumQueries(3):
+            rows = self.rept.generate()
+
+        self.assertEqual(rows[0]["variant_names"], ["a", "b"])
+        self.assertEqual([ [ vc["val"] for vc in row["variant_counts"] ]
+                           for row in rows ],
+                         [[3, 1], [2, 1], [1, 1], [0, 0]])
+        self.assertEqual(rows[2]["variant_counts"][0]["pct_round"], "50.00")
+        self.assertEqual(rows[2]["variant_counts"][0]["pct_cumulative_round"], "33.33")
+
+    def test_significance(self):
+        rows = self.rept.generate()
+        a, b = rows[1]["variant_counts"]
+        self.assertTrue(0 < a["ci_low"] < 2.0 / 3 < a["ci_high"] < 1)
+        self.assertFalse("p_value" in a)
+        self.assertTrue(b["prob_beats_control"] > 0.5)
+        self.assertTrue("chi_square" in rows[1])
+        self.assertFalse("chi_square" in rows[3])
+
+    def test_json(self):
+        request = make_request()
+        request.user = User(is_staff=True, is_active=True)
+        data = json.loads(views.experiment_report_json(
+                request, "funnel", str(self.rept.id)).content)
+        self.assertEqual(data["control"], "a")
+        self.assertEqual([ step["goal"] for step in data["steps"] ],
+                         [None, "seen", "signup", "missing"])
+        self.assertEqual(data["steps"][1]["variants"]["a"]["count"], 2)
+
+
+class ReportRollupTest(ExperimentReportTest):
+    def counts(self, rows):
+        return [ [ vc["val"] for vc in row["variant_counts"] ] for row in rows ]
+
+    def test_rollup_matches_live_counts(self):
+        call_command("splango_rollup", lag=0, verbosity=0)
+
+        # a goal for an old enrollment, and a new enrollment with an old goal
+        sub_a = Enrollment.objects.filter(variant="a")[2].subject
+        GoalRecord.record(sub_a, "seen", {})
+        sub_b = Subject.objects.create()
+        GoalRecord.record(sub_b, "seen", {})
+        call_command("splango_rollup", lag=0, verbosity=0)
+        self.exp.enroll_subject_as_variant(sub_b, "b")
+        call_command("splango_rollup", lag=0, verbosity=0)
+
+        live = self.counts(self.rept.generate())
+        self.assertEqual(live, [[3, 2], [3, 2], [1, 1], [0, 0]])
+
+        with override_settings(SPLANGO_REPORTS_FROM_ROLLUP=True):
+            self.assertEqual(self.counts(self.rept.generate()), live)
+
+            (day, rows), = self.rept.daily_series()
+            self.assertEqual(rows, [(None, [3, 2]), ("seen", [3, 2]),
+                                    ("signup", [1, 1]), ("missing", [0, 0])])
+
+
+    def test_late_import_counted_once(self):
+        call_command("splango_rollup", lag=0, verbosity=0)
+
+        earlier = timezone.now() - datetime.timedelta(hours=1)
+        new_sub = Subject.objects.create()
+        seen_only = [ e.subject for e in Enrollment.objects.filter(variant="a")
+                      if GoalRecord.objects.filter(subject=e.subject).count() == 1 ][0]
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "events.ndjson")
+
+        with open(path, "w") as f:
+            f.write(event_line(("enroll", new_sub.id, "funnel", "b"), earlier))
+            f.write(event_line(("goal", new_sub.id, "seen", {}, None), earlier))
+            f.write(event_line(("goal", seen_only.id, "signup", {}, None), earlier))
+
+        try:
+            # a second import finds nothing new to count
+            call_command("splango_import_events", path, path, verbosity=0)
+        finally:
+            shutil.rmtree(directory)
+
+        call_command("splango_rollup", lag=0, verbosity=0)
+
+        live = self.counts(self.rept.generate())
+        self.assertEqual(live, [[3, 2], [2, 2], [2, 1], [0, 0]])
+
+        with override_settings(SPLANGO_REPORTS_FROM_ROLLUP=True):
+            self.assertEqual(self.counts(self.rept.generate()), live)
+
+
+@override_settings(SPLANGO_IDENTITY="cookie", SPLANGO_ASSIGNMENT="hash")
+class CookieIdentityTest(SplangoTestCase):
+    def next_request(self, response=None):
+        request = make_request()
+        if response is not None:
+            request.COOKIES["splango"] = response.cookies["splango"].value
+        return request
+
+    def test_state_round_trips_through_cookie(self):
+        request = self.next_request()
+        rem = RequestExperimentManager(request)
+        rem.confirm_human()
+        v = rem.declare_and_enroll("cookieexp", ["a", "b", "c"])
+        response = rem.finish(HttpResponse(content_type="text/plain"))
+
+        self.assertFalse(request.session.modified)
+        sub = Enrollment.objects.get().subject
+
+        request = self.next_request(response)
+        rem = RequestExperimentManager(request)
+        with self.assertNumQueries(0):
+            self.assertEqual(rem.declare_and_enroll("cookieexp", ["a", "b", "c"]), v)
+        self.assertEqual(rem.get_subject().id, sub.id)
+        rem.finish(HttpResponse(content_type="text/plain"))
+        self.assertFalse(request.session.modified)
+
+    @override_settings(SPLANGO_ASSIGNMENT="random")
+    def test_random_assignment(self):
+        # variants aren't kept in the cookie; the subject id finds them
+        request = self.next_request()
+        rem = RequestExperimentManager(request)
+        rem.confirm_human()
+        v = rem.declare_and_enroll("cookieexp", [str(i) for i in range(20)])
+        response = rem.finish(HttpResponse(content_type="text/plain"))
+        self.assertFalse(request.session.modified)
+
+        for i in range(3):
+            request = self.next_request(response)
+            rem = RequestExperimentManager(request)
+            with self.assertNumQueries(1):
+                self.assertEqual(rem.declare_and_enroll("cookieexp", [str(i) for i in range(20)]), v)
+            self.assertEqual(rem.state.get(splango.SPLANGO_VARIANTS), None)
+            # nothing changed, so the cookie isn't sent again
+            self.assertFalse("splango" in rem.finish(HttpResponse()).cookies)
+
+        self.assertEqual(Enrollment.objects.get().variant, v)
+
+    @override_settings(SPLANGO_MAX_REMEMBERED_VARIANTS=3)
+    def test_remembered_variants_are_bounded(self):
+        request = self.next_request()
+        rem = RequestExperimentManager(request)
+        rem.confirm_human()
+
+        for i in range(3):
+            rem.declare_and_enroll("exp%d" % i, ["a", "b"])
+
+        # concluded experiments are forgotten first
+        Experiment.objects.filter(name="exp1").update(winner="a")
+        rem.declare_and_enroll("exp3", ["a", "b"])
+        remembered = rem.state[splango.SPLANGO_VARIANTS]
+        self.assertEqual(sorted(remembered), ["exp0", "exp2", "exp3"])
+
+        for i in range(4, 6):
+            rem.declare_and_enroll("exp%d" % i, ["a", "b"])
+        self.assertEqual(len(remembered), 3)
+        self.assertTrue("exp5" in remembered)
+
+        response = rem.finish(HttpResponse(content_type="text/plain"))
+        self.assertTrue(len(response.cookies["splango"].value) < 4096)
+
+    def test_tampered_cookie_is_ignored(self):
+        request = make_request()
+        request.COOKIES["splango"] = "garbage"
+        rem = RequestExperimentManager(request)
+        self.assertEqual(rem.state[splango.SPLANGO_STATE], splango.S_UNKNOWN)
+
+
+class InjectionTest(TestCase):
+    def test_inject_before_body_end(self):
+        self.assertEqual(inject_before_body_end("<p>x</p></BODY></html>", "JS"),
+                         "<p>x</p>JS</BODY></html>")
+        self.assertEqual(inject_before_body_end("no body here", "JS"),
+                         "no body here")
+
+    def test_body_end_far_from_tail(self):
+        page = "<p></p></body>" + " " * 10000
+        self.assertEqual(inject_before_body_end(page, "JS"),
+                         "<p></p>JS</body>" + " " * 10000)
+
+    def test_iterator_response(self):
+        response = HttpResponse(iter(["<p>", u"caf\xe9</bo", "dy>", ""]),
+                                content_type="text/html")
+        inject_into_response(response, "<script></script>")
+        self.assertEqual("".join(response),
+                         u"<p>caf\xe9<script></script></body>".encode("utf-8"))
+
+    def test_iterator_response_with_trailing_chunks(self):
+        chunks = ["<p>" * 1000] * 3 + ["</bo", "dy>"] + ["\n", "</html>", "\n"] * 50
+        response = HttpResponse(iter(chunks), content_type="text/html")
+        inject_into_response(response, "<script></script>")
+        self.assertEqual("".join(response),
+                         "".join(chunks).replace("</body>", "<script></script></body>"))
+
+    def test_finish_injects_for_unknown_visitor(self):
+        rem = RequestExperimentManager(make_request())
+        rem.declare_and_enroll("injected", ["a", "b"])
+        response = rem.finish(HttpResponse("<html><body></body></html>"))
+        self.assertTrue(response.content.startswith("<html><body><script"))
+        self.assertTrue(response.content.endswith("</script></body></html>"))
+
+
+class MergeTest(SplangoTestCase):
+    def setUp(self):
+        super(MergeTest, self).setUp()
+        self.exp1 = Experiment.declare("one", ["a", "b"])
+        self.exp2 = Experiment.declare("two", ["a", "b"])
+        self.old = Subject.objects.create()
+        self.new = Subject.objects.create()
+
+        self.exp1.enroll_subject_as_variant(self.old, "a")
+        self.exp2.enroll_subject_as_variant(self.old, "a")
+        self.exp1.enroll_subject_as_variant(self.new, "b")
+        GoalRecord.record(self.old, "shared", {"req_path": "/old"})
+        GoalRecord.record(self.old, "mine", {})
+        GoalRecord.record(self.new, "shared", {"req_path": "/new"})
+
+    def check_merged(self):
+        self.assertFalse(Subject.objects.filter(id=self.old.id).exists())
+        self.assertEqual(
+            sorted(Enrollment.objects.values_list("subject", "experiment__name", "variant")),
+            [(self.new.id, "one", "b"), (self.new.id, "two", "a")])
+        self.assertEqual(
+            sorted(GoalRecord.objects.values_list("subject", "goal__name", "req_path")),
+            [(self.new.id, "mine", None), (self.new.id, "shared", "/new")])
+
+    def test_merge_into(self):
+        self.old.merge_into(self.new)
+        self.check_merged()
+
+    def test_command(self):
+        call_command("splango_merge_subjects",
+                     "%d:%d" % (self.old.id, self.new.id), verbosity=0)
+        self.check_merged()
+
+
+class FastPathTest(SplangoTestCase):
+    def manager_for(self, path="/", **extra):
+        request = make_request(path, **extra)
+        ExperimentsMiddleware().process_request(request)
+        return request.experiments
+
+    @override_settings(STATIC_URL="/static/")
+    def test_exclusions(self):
+        self.assertTrue(isinstance(self.manager_for("/static/app.css"),
+                                   NullExperimentManager))
+        self.assertTrue(isinstance(
+                self.manager_for(HTTP_USER_AGENT="Mozilla/5.0 (compatible; Googlebot/2.1)"),
+                NullExperimentManager))
+        self.assertTrue(isinstance(
+                self.manager_for(HTTP_ACCEPT="application/json"),
+                RequestExperimentManager))
+
+        with override_settings(SPLANGO_EXCLUDE_NON_HTML_ACCEPT=True):
+            self.assertTrue(isinstance(
+                    self.manager_for(HTTP_ACCEPT="application/json"),
+                    NullExperimentManager))
+        self.assertTrue(isinstance(
+                self.manager_for(HTTP_ACCEPT="text/html,application/xml;q=0.9"),
+                RequestExperimentManager))
+
+    def test_null_manager(self):
+        request = make_request(HTTP_USER_AGENT="Googlebot")
+        mw = ExperimentsMiddleware()
+        mw.process_request(request)
+        rem = request.experiments
+
+        Experiment.declare("exp", ["a", "b"])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(rem.declare_and_enroll("exp", ["a", "b"]), "a")
+            rem.log_goal("goal")
+            rem.confirm_human()
+            response = mw.process_response(request, HttpResponse("<body></body>"))
+
+        self.assertEqual(response.content, "<body></body>")
+        self.assertEqual(request.session.keys(), [])
+
+    def test_null_manager_shows_winner(self):
+        exp = Experiment.declare("exp", ["a", "b"])
+        exp.winner = "b"
+        exp.save()
+        rem = NullExperimentManager(make_request(HTTP_USER_AGENT="Googlebot"))
+
+        self.assertEqual(rem.declare_and_enroll("exp", ["a", "b"]), "b")
+        self.assertEqual(rem.declare_and_enroll("new", ["a", "b"]), "a")
+        self.assertFalse(Experiment.objects.filter(name="new").exists())
+
+    def test_unused_manager_leaves_session_alone(self):
+        request = make_request()
+        rem = RequestExperimentManager(request)
+        response = rem.finish(HttpResponse("<html><body></body></html>"))
+        self.assertEqual(request.session.keys(), [])
+        self.assertEqual(response.content, "<html><body></body></html>")
+
+    @override_settings(SPLANGO_FIRST_VISIT_GOAL="firstvisit")
+    def test_first_visit_goal_still_logged(self):
+        request = make_request()
+        rem = RequestExperimentManager(request)
+        rem.finish(HttpResponse(""))
+        self.assertEqual(request.session[splango.SPLANGO_QUEUED_UPDATES][0][0],
+                         "log_goal")
+
+
+class RequestMemoTest(SplangoTestCase):
+    def human_manager(self, sub=None):
+        request = make_request()
+        request.session[splango.SPLANGO_STATE] = splango.S_HUMAN
+        if sub is not None:
+            request.session[splango.SPLANGO_SUBJECT] = sub
+        return RequestExperimentManager(request)
+
+    def test_repeat_declarations_are_free(self):
+        sub = Subject.objects.create()
+        for name in ("one", "two"):
+            Experiment.declare(name, ["a", "b"]).enroll_subject_as_variant(sub, "b")
+
+        rem = self.human_manager(sub)
+
+        # one query reads all the subject's enrollments
+        with self.assertNumQueries(1):
+            for i in range(3):
+                self.assertEqual(rem.declare_and_enroll("one", ["a", "b"]), "b")
+                self.assertEqual(rem.declare_and_enroll("two", ["a", "b"]), "b")
+
+        self.assertEqual(rem.declared_variant("one"), "b")
+        self.assertEqual(rem.declared_variant("three"), None)
+
+    def test_unconfirmed_visitor_enrolled_once(self):
+        rem = RequestExperimentManager(make_request())
+        v = rem.declare_and_enroll("memo", ["a", "b", "c", "d"])
+
+        for i in range(10):
+            self.assertEqual(rem.declare_and_enroll("memo", ["a", "b", "c", "d"]), v)
+
+        self.assertEqual(len(rem.queued_actions), 1)
+
+    def test_hyp_uses_variant_declared_in_view(self):
+        request = make_request()
+        request.experiments = NullExperimentManager(request)
+        request.experiments.declare_and_enroll("signup", ["control", "free"])
+        source = ('{% load splangotags %}'
+                  '{% hyp "signup" "control" %}C{% endhyp %}'
+                  '{% hyp "signup" "free" %}F{% endhyp %}')
+        self.assertEqual(Template(source).render(Context({"request": request})), "C")
+
+    def test_switch_and_variant_use_variant_declared_in_view(self):
+        request = make_request()
+        request.experiments = NullExperimentManager(request)
+        request.experiments.declare_and_enroll("signup", ["control", "free"])
+        context = Context({"request": request})
+
+        self.assertEqual(Template(TemplateTagTest.SWITCH).render(context),
+                         "sign up!")
+        source = ('{% load splangotags %}'
+                  '{% hypvariant "signup" as v %}[{{ v }}]')
+        self.assertEqual(Template(source).render(context), "[control]")
+
+        # still an error when nothing declared it
+        request.experiments = NullExperimentManager(request)
+        self.assertRaises(TemplateSyntaxError,
+                          Template(source).render, Context({"request": request}))
+
+
+class BenchmarkSmokeTest(SplangoTestCase):
+    def test_runs(self):
+        results = list(benchmark.run(ops=2, report_sizes=(10,)))
+        self.assertTrue(results)
+        for r in results:
+            self.assertTrue(r.queries_per_op() >= 0)
+
+
+class FileSinkTest(SplangoTestCase):
+    def setUp(self):
+        super(FileSinkTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_log_and_import(self):
+        sub = Subject.objects.create()
+        Experiment.declare("logged", ["a", "b"])
+
+        with override_settings(SPLANGO_EVENT_LOG_DIR=self.directory):
+            sink = FileSink()
+
+        self.assertEqual(sink.enroll(sub, "logged", "b"), "b")
+        sink.enroll(sub, "logged", "a")
+        sink.record_goal(sub, "signup", {"req_path": "/x"})
+        sink.record_goal(sub, "signup", {"req_path": "/y"})
+        self.assertFalse(Enrollment.objects.exists())
+
+        logged = timezone.now()
+
+        paths = [ os.path.join(self.directory, f)
+                  for f in os.listdir(self.directory) ]
+        call_command("splango_import_events", *paths, verbosity=0)
+
+        self.assertEqual(Enrollment.objects.get(subject=sub).variant, "b")
+        self.assertEqual(GoalRecord.objects.get(subject=sub).req_path, "/x")
+
+        # stamped with when they happened, not when they were imported
+        self.assertTrue(Enrollment.objects.get(subject=sub).created <= logged)
+        self.assertTrue(GoalRecord.objects.get(subject=sub).created <= logged)
+
+
+@override_settings(SPLANGO_STATS_BACKEND="splango.stats.LocalBackend")
+class InstrumentationTest(SplangoTestCase):
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        get_backend().reset()
+
+    def test_operations_are_measured(self):
+        request = make_request()
+        mw = ExperimentsMiddleware()
+        mw.process_request(request)
+        request.experiments.confirm_human()
+        request.experiments.declare_and_enroll("measured", ["a", "b"])
+        request.experiments.log_goal("measured.goal")
+
+        with override_settings(DEBUG=True):
+            response = mw.process_response(request, HttpResponse(""))
+
+        self.assertEqual(sorted(get_backend().timings),
+                         ["confirm_human", "declare_and_enroll", "finish",
+                          "log_goal"])
+        self.assertTrue("declare_and_enroll=1/" in response[HEADER])
+        self.assertTrue(request.experiments.stats.ops["finish"][2] > 0)
+
+    def test_bad_backend_path(self):
+        with override_settings(SPLANGO_STATS_BACKEND="splango.stats.NoSuchBackend"):
+            self.assertRaises(ImproperlyConfigured, get_backend)
+
+
+class TemplateTagTest(TestCase):
+    SWITCH = ('{% load splangotags %}'
+              '{% hypswitch "signup" %} ignored '
+              '{% case "control" %}sign up'
+              '{% case "free" "trial" %}try it'
+              '{% default %}welcome'
+              '{% endhypswitch %}!')
+
+    def render(self, source, variant):
+        context = Context({"__splango__experiment__signup": variant})
+        return Template(source).render(context)
+
+    def test_hypswitch(self):
+        self.assertEqual(self.render(self.SWITCH, "control"), "sign up!")
+        self.assertEqual(self.render(self.SWITCH, "trial"), "try it!")
+        self.assertEqual(self.render(self.SWITCH, "other"), "welcome!")
+
+    def test_hypswitch_requires_declaration(self):
+        self.assertRaises(TemplateSyntaxError,
+                          Template(self.SWITCH).render, Context({}))
+
+    def test_adjacent_hyps(self):
+        source = ('{% load splangotags %}'
+                  '{% hyp "signup" "a" %}A{% endhyp %}'
+                  '{% hyp "signup" "b" %}B{% endhyp %}')
+        self.assertEqual(self.render(source, "a"), "A")
+        self.assertEqual(self.render(source, "b"), "B")
+
+    def test_declare_and_hypvariant(self):
+        request = make_request()
+        request.experiments = NullExperimentManager(request)
+        source = ('{% load splangotags %}'
+                  '{% experiment "signup" variants "control,free" %}'
+                  '{% hypvariant "signup" as v %}[{{ v }}]')
+        self.assertEqual(Template(source).render(Context({"request": request})),
+                         "[control]")
+
+
+class FixedVariants(object):
+    """A stand-in request.experiments that assigns preset variants."""
+
+    def __init__(self, variants):
+        self.variants = variants
+
+    def declare_and_enroll(self, exp_name, variants, weights=None):
+        return self.variants[exp_name]
+
+
+class VariantCacheTest(TestCase):
+    def request_in(self, **variants):
+        request = make_request("/landing/")
+        request.experiments = FixedVariants(variants)
+        return request
+
+    def test_key_depends_on_variants(self):
+        exps = {"one": ["a", "b"], "two": ["x", "y"]}
+        key = variant_cache_key(self.request_in(one="a", two="x"), exps)
+        self.assertEqual(key, variant_cache_key(self.request_in(one="a", two="x"), exps))
+        self.assertNotEqual(key, variant_cache_key(self.request_in(one="b", two="x"), exps))
+
+    def test_cache_per_variant(self):
+        calls = []
+
+        @cache_per_variant(60, {"one": ["a", "b"]}, key_prefix="test%s" % id(calls))
+        def view(request):
+            calls.append(1)
+            return HttpResponse("page %d" % len(calls))
+
+        self.assertEqual(view(self.request_in(one="a")).content, "page 1")
+        self.assertEqual(view(self.request_in(one="b")).content, "page 2")
+        self.assertEqual(view(self.request_in(one="a")).content, "page 1")
+        self.assertEqual(len(calls), 2)
+
+    def test_private_and_vary(self):
+        calls = []
+
+        @cache_per_variant(60, {"one": ["a", "b"]}, key_prefix="vary%s" % id(calls))
+        def view(request):
+            calls.append(1)
+            response = HttpResponse("page %d for %s" % (
+                    len(calls), request.META.get("HTTP_ACCEPT_LANGUAGE")))
+            if request.path == "/account/":
+                response["Cache-Control"] = "private, max-age=0"
+            else:
+                response["Vary"] = "Accept-Language"
+            return response
+
+        en = self.request_in(one="a")
+        en.META["HTTP_ACCEPT_LANGUAGE"] = "en"
+        fr = self.request_in(one="a")
+        fr.META["HTTP_ACCEPT_LANGUAGE"] = "fr"
+
+        self.assertEqual(view(en).content, "page 1 for en")
+        self.assertEqual(view(fr).content, "page 2 for fr")
+        self.assertEqual(view(en).content, "page 1 for en")
+
+        for i in range(2):
+            account = self.request_in(one="a")
+            account.path = "/account/"
+            view(account)
+        self.assertEqual(len(calls), 4)
+
+
+class DeferredConfirmTest(SplangoTestCase):
+    def setUp(self):
+        super(DeferredConfirmTest, self).setUp()
+        self.saved_writer = writer._writer
+        writer._writer = EventWriter(background=False)
+
+    def tearDown(self):
+        writer._writer = self.saved_writer
+
+    @override_settings(SPLANGO_DEFER_CONFIRM=True)
+    def test_confirm_defers_queued_writes(self):
+        request = make_request()
+        rem = RequestExperimentManager(request)
+        rem.declare_and_enroll("deferred", ["a", "b"])
+        rem.log_goal("deferred.goal")
+        rem.finish(HttpResponse(""))
+
+        rem = RequestExperimentManager(request)
+        with self.assertNumQueries(1): # creating the subject
+            rem.confirm_human()
+        self.assertFalse(Enrollment.objects.exists())
+
+        writer._writer.flush()
+        self.assertEqual(Enrollment.objects.count(), 1)
+        self.assertEqual(GoalRecord.objects.count(), 1)
+
+    @override_settings(SPLANGO_DEFER_CONFIRM=True,
+                       SPLANGO_EVENT_SINK="splango.sinks.FileSink")
+    def test_configured_sink_sees_deferred_writes(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            with override_settings(SPLANGO_EVENT_LOG_DIR=directory):
+                request = make_request()
+                rem = RequestExperimentManager(request)
+                rem.log_goal("deferred.goal")
+                rem.finish(HttpResponse(""))
+
+                RequestExperimentManager(request).confirm_human()
+                writer._writer.flush()
+
+            self.assertFalse(GoalRecord.objects.exists())
+            self.assertEqual(len(os.listdir(directory)), 1)
+        finally:
+            loading._loaded.clear()
+            shutil.rmtree(directory)
+
+    def test_middleware_is_callable(self):
+        mw = ExperimentsMiddleware(lambda request: HttpResponse("ok"))
+        request = make_request()
+        self.assertEqual(mw(request).content, "ok")
+        self.assertTrue(isinstance(request.experiments, RequestExperimentManager))
+
+
+class QueueReplayTest(SplangoTestCase):
+    def test_coalesce_actions(self):
+        actions = [("enroll", {"exp_name": "e", "variant": "a"}),
+                   ("log_goal", {"goal_name": "g", "request_info": {}, "extra": None}),
+                   ("enroll", {"exp_name": "e", "variant": "b"}),
+                   ("log_goal", {"goal_name": "g", "request_info": {}, "extra": "x"})]
+        self.assertEqual(coalesce_actions(actions),
+                         [("enroll", {"exp_name": "e", "variant": "a"}),
+                          ("log_goal", {"goal_name": "g", "request_info": {}, "extra": "x"})])
+
+    def test_confirm_replays_queue_in_bulk_once(self):
+        request = make_request()
+
+        for i in range(5):
+            rem = RequestExperimentManager(request)
+            for n in range(4):
+                rem.declare_and_enroll("replay%d" % n, ["a", "b"])
+                rem.log_goal("replay.goal%d" % n)
+            rem.finish(HttpResponse(""))
+
+        self.assertEqual(len(request.session[SPLANGO_QUEUED_UPDATES]), 8)
+
+        rem = RequestExperimentManager(request)
+        with self.assertNumQueries(8):
+            # subject; a select and an insert each for enrollments and
+            # goal records; goals are looked up, created and read back
+            rem.confirm_human()
+        self.assertEqual(Enrollment.objects.count(), 4)
+        self.assertEqual(GoalRecord.objects.count(), 4)
+        self.assertFalse(SPLANGO_QUEUED_UPDATES in request.session)
+
+        with self.assertNumQueries(0):
+            RequestExperimentManager(request).confirm_human()
+
+
+class HumanConfirmationTest(SplangoTestCase):
+    BROWSER = {"HTTP_USER_AGENT": "Mozilla/5.0 (X11; Linux x86_64) Firefox/60.0",
+               "HTTP_ACCEPT": "text/html,application/xhtml+xml",
+               "HTTP_ACCEPT_LANGUAGE": "en",
+               "HTTP_ACCEPT_ENCODING": "gzip"}
+
+    @override_settings(SPLANGO_CONFIRM="cookie")
+    def test_cookie_confirms_next_request(self):
+        request = make_request()
+        rem = RequestExperimentManager(request)
+        rem.declare_and_enroll("humans", ["a", "b"])
+        response = rem.finish(HttpResponse("<html><body></body></html>"))
+        self.assertFalse("jQuery" in response.content)
+        self.assertTrue("document.cookie" in response.content)
+        self.assertFalse(Enrollment.objects.exists())
+
+        token = re.search(r'splango_human=([^;]+);', response.content).group(1)
+        request.COOKIES["splango_human"] = token
+        rem = RequestExperimentManager(request)
+        self.assertEqual(rem.state[splango.SPLANGO_STATE], splango.S_HUMAN)
+        self.assertEqual(Enrollment.objects.count(), 1)
+
+    def test_forged_cookie_is_ignored(self):
+        request = make_request()
+        request.COOKIES["splango_human"] = "human:1:forged"
+        rem = RequestExperimentManager(request)
+        self.assertEqual(rem.state[splango.SPLANGO_STATE], splango.S_UNKNOWN)
+
+    @override_settings(SPLANGO_HUMAN_CLASSIFIER="splango.humans.classify_by_headers")
+    def test_classifier_confirms_browsers(self):
+        rem = RequestExperimentManager(make_request(**self.BROWSER))
+        self.assertEqual(rem.state[splango.SPLANGO_STATE], splango.S_HUMAN)
+        response = rem.finish(HttpResponse("<html><body></body></html>"))
+        self.assertFalse("<script" in response.content)
+
+        rem = RequestExperimentManager(make_request(HTTP_USER_AGENT="Mozilla/5.0"))
+        self.assertEqual(rem.state[splango.SPLANGO_STATE], splango.S_UNKNOWN)
+
+
+class SignificanceTest(TestCase):
+    def test_wilson_interval(self):
+        low, high = significance.wilson_interval(10, 100)
+        self.assertAlmostEqual(low, 0.0552, 4)
+        self.assertAlmostEqual(high, 0.1744, 4)
+        self.assertEqual(significance.wilson_interval(0, 0), (None, None))
+        self.assertEqual(significance.wilson_interval(12, 10),
+                         significance.wilson_interval(10, 10))
+
+    def test_tests_agree_for_two_variants(self):
+        z, p = significance.z_test(10, 100, 15, 100)
+        chi2, chi2_p = significance.chi_square_test([10, 15], [100, 100])
+        self.assertAlmostEqual(z * z, chi2)
+        self.assertAlmostEqual(p, chi2_p)
+        self.assertAlmostEqual(p, 0.2850, 4)
+
+    def test_chi_square_p_value(self):
+        # two degrees of freedom: p = exp(-statistic / 2)
+        chi2, p = significance.chi_square_test([10, 15, 30], [100, 100, 100])
+        self.assertAlmostEqual(p, math.exp(-chi2 / 2))
+
+    def test_prob_beats(self):
+        self.assertAlmostEqual(significance.prob_beats(0, 0, 0, 0), 0.5)
+        self.assertAlmostEqual(significance.prob_beats(10, 100, 15, 100),
+                               1 - significance.prob_beats(15, 100, 10, 100))
+        self.assertTrue(significance.prob_beats(10, 100, 15, 100) > 0.8)
+        # the normal approximation takes over for large counts
+        self.assertTrue(0.98 < significance.prob_beats(1500, 5000, 1600, 5000) < 0.99)
+
+
+class ActivityLogTest(SplangoTestCase):
+    def setUp(self):
+        super(ActivityLogTest, self).setUp()
+        self.exp = Experiment.declare("log", ["a", "b"])
+        self.goal = Goal.objects.create(name="log.goal")
+        base = datetime.datetime(2012, 1, 1)
+
+        for i in range(5):
+            sub = Subject.objects.create()
+            self.exp.enroll_subject_as_variant(sub, "a" if i < 4 else "b")
+            if i != 3:
+                GoalRecord.record(sub, "log.goal", {})
+            # ties on created are broken by kind, then id
+            Enrollment.objects.filter(subject=sub).update(
+                created=base + datetime.timedelta(minutes=i))
+            GoalRecord.objects.filter(subject=sub).update(
+                created=base + datetime.timedelta(minutes=i // 2))
+
+    def entries(self, activities):
+        return [ (a.kind, a.subject_id) for a in activities ]
+
+    def test_pages_follow_on(self):
+        everything = activity.activity_page(self.exp, "a", self.goal)
+        self.assertEqual(len(everything), 6)
+        self.assertEqual(everything, sorted(everything, key=lambda a: a.key()))
+
+        pages = []
+        after = None
+
+        while True:
+            with self.assertNumQueries(1):
+                page = activity.activity_page(self.exp, "a", self.goal,
+                                              after, limit=4)
+            pages.extend(page)
+            if len(page) < 4:
+                break
+            after = activity.decode_cursor(activity.encode_cursor(page[-1]))
+
+        self.assertEqual(self.entries(pages), self.entries(everything))
+        self.assertEqual(self.entries(activity.iter_activity(
+                    self.exp, "a", self.goal, chunk_size=2)),
+                         self.entries(everything))
+
+    def test_bad_cursor(self):
+        self.assertEqual(activity.decode_cursor("nonsense"), None)
+        self.assertEqual(activity.decode_cursor("x_1_2"), None)
+
+    def test_csv(self):
+        request = make_request("/", data={"format": "csv"})
+        request.user = User(is_staff=True, is_active=True)
+        response = views.experiment_log(request, "log", "a", "log.goal")
+        lines = response.content.splitlines()
+        self.assertEqual(lines[0].split(",")[:4],
+                         ["time", "subject", "registered", "type"])
+        self.assertEqual(len(lines), 7)
+
+
+class ExportTest(SplangoTestCase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.exp = Experiment.declare("exported", ["a", "b"])
+
+        for i in range(5):
+            sub = Subject.objects.create()
+            self.exp.enroll_subject_as_variant(sub, "ab"[i % 2])
+            for g in ["seen", "signup"][:i % 3]:
+                GoalRecord.record(sub, g, {})
+
+    def test_chunks_cover_everything(self):
+        with self.assertNumQueries(6):
+            rows = [ r for chunk in export.iter_chunks(self.exp, chunk_size=2)
+                     for r in chunk ]
+        self.assertEqual(len(rows), 1 + 1 + 2 + 1 + 1)
+        self.assertEqual(len(set(r[0] for r in rows)), 5)
+
+    def test_columns_round_trip(self):
+        rows = [ r for chunk in export.iter_chunks(self.exp) for r in chunk ]
+        lines = list(export.column_lines(self.exp, chunk_size=2))
+        self.assertEqual(len(lines), 4)
+        self.assertEqual([ r[:3] + (r[4],) for r in export.read_columns(lines) ],
+                         [ r[:3] + (r[4],) for r in rows ])
+
+    def test_command_writes_csv(self):
+        path = tempfile.mktemp()
+        try:
+            call_command("splango_export", "exported", output=path)
+            with open(path) as f:
+                lines = f.read().splitlines()
+        finally:
+            os.remove(path)
+        self.assertEqual(lines[0], ",".join(export.COLUMNS))
+        self.assertEqual(len(lines), 7)
+
+
+class BanditTest(SplangoTestCase):
+    def setUp(self):
+        super(BanditTest, self).setUp()
+        self.saved_snapshot = bandit._snapshot
+        bandit._snapshot = BanditSnapshot(background=False)
+
+        self.exp = Experiment.declare("armed", ["loser", "winner"])
+        self.exp.allocation = bandit.ALLOCATE_THOMPSON
+        self.exp.bandit_goal = "armed.goal"
+        self.exp.save()
+
+        for i in range(40):
+            sub = Subject.objects.create()
+            variant = ["loser", "winner"][i % 2]
+            self.exp.enroll_subject_as_variant(sub, variant)
+            if variant == "winner" or i % 10 == 0:
+                GoalRecord.record(sub, "armed.goal", {})
+
+    def tearDown(self):
+        bandit._snapshot = self.saved_snapshot
+
+    def test_uniform_until_refreshed(self):
+        self.assertEqual(bandit._snapshot.get("armed"), None)
+        with self.assertNumQueries(0):
+            self.exp.get_random_variant()
+
+    def test_thompson_prefers_winner(self):
+        bandit._snapshot.refresh()
+        self.assertEqual(bandit._snapshot.get("armed"),
+                         {"loser": (20, 4), "winner": (20, 20)})
+
+        with self.assertNumQueries(0):
+            picks = [ self.exp.get_random_variant() for i in range(200) ]
+        self.assertTrue(picks.count("winner") > 190)
+
+    @override_settings(SPLANGO_BANDIT_EPSILON=0)
+    def test_epsilon_greedy(self):
+        self.exp.allocation = bandit.ALLOCATE_EPSILON
+        bandit._snapshot.refresh()
+        self.assertEqual(set(self.exp.get_random_variant() for i in range(20)),
+                         set(["winner"]))
+
+
+class ExperimentControlsTest(SplangoTestCase):
+    def human_manager(self):
+        request = make_request()
+        request.session[splango.SPLANGO_STATE] = splango.S_HUMAN
+        return RequestExperimentManager(request)
+
+    def configure(self, **fields):
+        exp = Experiment.declare("controlled", ["control", "new"])
+        for name, value in fields.items():
+            setattr(exp, name, value)
+        exp.save()
+        Experiment.declare("controlled", ["control", "new"]) # cache it
+
+    def test_paused_shows_control_without_queries(self):
+        self.configure(active=False)
+        for i in range(10):
+            rem = self.human_manager()
+            with self.assertNumQueries(0):
+                self.assertEqual(rem.declare_and_enroll("controlled", ["control", "new"]),
+                                 "control")
+        self.assertFalse(Enrollment.objects.exists())
+
+    def test_exposure(self):
+        self.configure(exposure=30)
+        exposed = 0
+
+        for i in range(200):
+            rem = self.human_manager()
+            key = rem.get_assignment_key()
+            rem.declare_and_enroll("controlled", ["control", "new"])
+            if Experiment.declare("controlled", []).exposes(key):
+                exposed += 1
+
+        self.assertEqual(Enrollment.objects.count(), exposed)
+        self.assertTrue(30 < exposed < 90)
+
+    def test_stored_weights(self):
+        self.configure(weights="0, 1")
+        rem = self.human_manager()
+        self.assertEqual(rem.declare_and_enroll("controlled", ["control", "new"]), "new")
+
+    def test_concluded_shows_winner_without_queries(self):
+        self.configure(winner="new")
+        rem = self.human_manager()
+        with self.assertNumQueries(0):
+            self.assertEqual(rem.declare_and_enroll("controlled", ["control", "new"]),
+                             "new")
+        self.assertFalse(Enrollment.objects.exists())
+
+    def test_clean(self):
+        exp = Experiment(name="x", variants="a\nb", weights="1")
+        self.assertRaises(ValidationError, exp.clean)
+        exp.weights = "1, 2"
+        exp.clean()
+        exp.winner = "c"
+        self.assertRaises(ValidationError, exp.clean)
+        exp.winner = "b"
+        exp.clean()
+
+
+class ArchiveTest(SplangoTestCase):
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_archive_and_restore(self):
+        done = Experiment.declare("done", ["a", "b"])
+        running = Experiment.declare("running", ["a", "b"])
+        subs = [ Subject.objects.create() for i in range(3) ]
+
+        for sub in subs:
+            done.enroll_subject_as_variant(sub, "a")
+            running.enroll_subject_as_variant(sub, "b")
+        GoalRecord.record(subs[0], "signup", {"req_path": "/x"})
+        created = sorted(Enrollment.objects.values_list("created", flat=True))
+
+        # nothing is archived until the rollups have counted it
+        self.assertEqual(archive.archive(self.directory), (None, 0, 0))
+
+        call_command("splango_rollup", lag=0, verbosity=0)
+        counted = self.rollup_counts(running)
+        self.assertEqual(counted, [[0, 3], [0, 1]])
+        done.winner = "a"
+        done.save()
+
+        call_command("splango_archive", dir=self.directory, concluded=True,
+                     verbosity=0)
+        self.assertEqual(Enrollment.objects.filter(experiment=done).count(), 0)
+        self.assertEqual(Enrollment.objects.filter(experiment=running).count(), 3)
+        self.assertEqual(GoalRecord.objects.count(), 1)
+
+        # age alone doesn't move a live experiment's rows
+        later = timezone.now() + datetime.timedelta(days=1)
+        self.assertEqual(archive.archive(self.directory, concluded=False,
+                                         before=later), (None, 0, 0))
+
+        running.active = False
+        running.save()
+        path, enrollments, goalrecords = archive.archive(
+            self.directory, concluded=False, before=later)
+        self.assertEqual((enrollments, goalrecords), (3, 1))
+        self.assertFalse(Enrollment.objects.exists())
+        self.assertFalse(GoalRecord.objects.exists())
+
+        paths = [ os.path.join(self.directory, f)
+                  for f in os.listdir(self.directory) ]
+        self.assertEqual(len(paths), 2)
+        # the rollups can't be recounted while the rows are away
+        self.assertRaises(RuntimeError, update_rollups, lag=0, rebuild=True)
+
+        call_command("splango_import_events", *paths, verbosity=0)
+
+        self.assertEqual(Enrollment.objects.filter(experiment=done).count(), 3)
+        self.assertEqual(Enrollment.objects.filter(experiment=running).count(), 3)
+        self.assertEqual(GoalRecord.objects.get().req_path, "/x")
+        self.assertEqual(sorted(Enrollment.objects.values_list("created", flat=True)),
+                         created)
+
+        # restored rows are counted once, and the rollups can be rebuilt
+        call_command("splango_rollup", lag=0, verbosity=0)
+        self.assertEqual(self.rollup_counts(running), counted)
+        call_command("splango_rollup", rebuild=True, lag=0, verbosity=0)
+        self.assertEqual(self.rollup_counts(running), counted)
+
+    def test_returning_subject_of_live_experiment(self):
+        running = Experiment.declare("running", ["a", "b"])
+        sub = Subject.objects.create()
+        running.enroll_subject_as_variant(sub, "b")
+        GoalRecord.record(sub, "signup", {"req_path": "/x"})
+        # a goal record of a subject in no live experiment can go
+        GoalRecord.record(Subject.objects.create(), "signup", {})
+        call_command("splango_rollup", lag=0, verbosity=0)
+        counted = self.rollup_counts(running)
+
+        path, enrollments, goalrecords = archive.archive(
+            self.directory, concluded=False,
+            before=timezone.now() + datetime.timedelta(days=1))
+        self.assertEqual((enrollments, goalrecords), (0, 1))
+
+        request = make_request()
+        request.session[splango.SPLANGO_STATE] = splango.S_HUMAN
+        request.session[splango.SPLANGO_SUBJECT] = sub
+        rem = RequestExperimentManager(request)
+        self.assertEqual(rem.declare_and_enroll("running", ["a", "b"]), "b")
+        rem.log_goal("signup")
+        rem.finish(HttpResponse(""))
+
+        self.assertEqual(GoalRecord.objects.filter(subject=sub).count(), 1)
+        self.assertEqual(GoalRecord.objects.get(subject=sub).req_path, "/x")
+        call_command("splango_rollup", lag=0, verbosity=0)
+        self.assertEqual(self.rollup_counts(running), counted)
+
+    def rollup_counts(self, exp):
+        rept = ExperimentReport(experiment=exp, funnel="signup")
+        with override_settings(SPLANGO_REPORTS_FROM_ROLLUP=True):
+            return [ [ vc["val"] for vc in row["variant_counts"] ]
+                     for row in rept.generate() ]
@@ -7,8 +7,12 @@ urlpatterns = patterns(
     url(r'^admin/$', 'experiments_overview', name="splango-admin"),
     url(r'^admin/exp/(?P<expname>[^/]+)/$', 'experiment_detail', name="splango-experiment-detail"),
 
+    url(r'^admin/exp/(?P<expname>[^/]+)/export/$', 'experiment_export', name="splango-experiment-export"),
+
     url(r'^admin/exp/(?P<expname>[^/]+)/(?P<report_id>\d+)/$', 'experiment_report', name="splango-experiment-report"),
 
+    url(r'^admin/exp/(?P<expname>[^/]+)/(?P<report_id>\d+)/json/$', 'experiment_report_json', name="splango-experiment-report-json"),
+
     url(r'^admin/exp/(?P<expname>[^/]+)/(?P<variant>[^/]+)/(?P<goal>[^/]+)/$', 'experiment_log', name="splango-experiment-log"),
 
     )
@@ -1,10 +1,15 @@
+import csv
+import json
+
+from django.conf import settings
 from django.template import RequestContext
 from django.views.decorators.cache import never_cache
 from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render_to_response, get_object_or_404
 
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
 
+from splango import activity, export
 from splango.models import *
 
 @never_cache
@@ -25,7 +30,7 @@ def experiments_overview(request):
         repts_by_id.setdefault(r.experiment_id, []).append(r)
 
     for exp in exps:
-        exp.reports = repts_by_id.get(exp.name, [])
+        exp.reports = repts_by_id.get(exp.id, [])
 
     return render_to_response("splango/experiments_overview.html",
                               {"title":"Experiments",
@@ -53,39 +58,129 @@ def experiment_report(request, expname, report_id):
 
     report_rows = rept.generate()
 
+    if getattr(settings, "SPLANGO_REPORTS_FROM_ROLLUP", False):
+        daily_rows = rept.daily_series()
+        marks = RollupMark.objects.order_by("id")[:1]
+        rollup_mark = marks[0].mark if marks else None
+    else:
+        daily_rows = rollup_mark = None
+
     return render_to_response("splango/experiment_report.html",
                               { "title": rept.title,
                                 "exp": rept.experiment,
                                 "rept": rept,
                                 "report_rows": report_rows,
+                                "daily_rows": daily_rows,
+                                "rollup_mark": rollup_mark,
                                 },
                               RequestContext(request))
 
 
+_JSON_FIELDS = ("pct", "pct_cumulative", "ci_low", "ci_high", "z", "p_value",
+                "prob_beats_control")
+
+
+@staff_member_required
+def experiment_report_json(request, expname, report_id):
+    """The report's counts and statistics, for spreadsheets and scripts."""
+
+    rept = get_object_or_404(ExperimentReport, id=report_id,
+                             experiment__name=expname)
+
+    report_rows = rept.generate()
+    variants = report_rows[0]["variant_names"]
+
+    steps = []
+
+    for row in report_rows:
+        step = { "goal": row["goal"],
+                 "chi_square": row.get("chi_square"),
+                 "chi_square_p": row.get("chi_square_p"),
+                 "variants": {} }
+
+        for vc in row["variant_counts"]:
+            data = { "count": vc["val"] }
+            data.update((f, vc.get(f)) for f in _JSON_FIELDS)
+            step["variants"][vc["variant_name"]] = data
+
+        steps.append(step)
+
+    data = { "experiment": expname,
+             "report": rept.title,
+             "variants": variants,
+             "control": variants[0] if variants else None,
+             "steps": steps }
+
+    return HttpResponse(json.dumps(data, indent=1),
+                        content_type="application/json")
+
+
+def _activity_csv(activities, goal):
+    writer = csv.writer(export.Echo())
+
+    yield writer.writerow(["time", "subject", "registered", "type",
+                           "remote_addr", "path", "referer"])
+
+    for act in activities:
+        yield writer.writerow([ unicode(v).encode("utf-8") for v in [
+                    act.created.isoformat(), act.subject_id,
+                    int(act.registered),
+                    "enrollment" if act.is_enrollment() else goal.name,
+                    act.req_REMOTE_ADDR or "", act.req_path or "",
+                    act.req_HTTP_REFERER or "" ] ])
+
+
 @staff_member_required
 def experiment_log(request, expname, variant, goal):
     exp = get_object_or_404(Experiment, name=expname)
     goal = get_object_or_404(Goal, name=goal)
 
-    enrollments = Enrollment.objects.filter(experiment=exp, 
-                                            variant=variant, 
-                                            subject__goals=goal).select_related("subject")[:1000]
-    # 1000 limit is just there to keep this page sane
+    after = activity.decode_cursor(request.GET.get("after", ""))
 
-    goalrecords = GoalRecord.objects.filter(
-        goal=goal,
-        subject__in=[ e.subject for e in enrollments ]).select_related("goal","subject")
+    if request.GET.get("format") == "csv":
+        response = HttpResponse(
+            _activity_csv(activity.iter_activity(exp, variant, goal, after),
+                          goal),
+            content_type="text/csv")
+        response["Content-Disposition"] = \
+            "attachment; filename=splango-%s-%s-%s.csv" % (exp.name, variant,
+                                                         goal.name)
+        return response
 
-    title = "Experiment Log: variant %s, goal %s" % (variant, goal)
+    activities = activity.activity_page(exp, variant, goal, after)
 
-    activities = list(enrollments)+list(goalrecords)
+    if len(activities) == activity.PAGE_SIZE:
+        next_cursor = activity.encode_cursor(activities[-1])
+    else:
+        next_cursor = None
 
-    activities.sort(key=lambda x: x.created)
+    title = "Experiment Log: variant %s, goal %s" % (variant, goal)
 
     return render_to_response("splango/experiment_log.html",
                               { "exp": exp,
+                                "goal": goal,
                                 "activities": activities,
+                                "paged": after is not None,
+                                "next_cursor": next_cursor,
                                 "title": title },
                               RequestContext(request))
 
 
+@staff_member_required
+def experiment_export(request, expname):
+    exp = get_object_or_404(Experiment, name=expname)
+    format = request.GET.get("format", export.FORMAT_CSV)
+
+    if format not in export.FORMATS:
+        raise Http404
+
+    if format == export.FORMAT_CSV:
+        content_type, extension = "text/csv", "csv"
+    else:
+        content_type, extension = "application/x-ndjson", "ndjson"
+
+    response = HttpResponse(export.export_lines(exp, format),
+                            content_type=content_type)
+    response["Content-Disposition"] = \
+        "attachment; filename=splango-%s.%s" % (exp.name, extension)
+    return response
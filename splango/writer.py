@@ -0,0 +1,369 @@
+"""Write-behind pipeline for goal records and enrollments.
+
+With settings.SPLANGO_WRITE_BEHIND = True, RequestExperimentManager hands
+goals and enrollments to an in-process bounded queue instead of writing
+them while the response is being built. A daemon thread drains the queue
+and writes each batch with a few bulk queries, skipping rows that would
+violate the (subject, goal) and (subject, experiment) unique constraints.
+
+Settings:
+
+  SPLANGO_WRITER_BATCH_SIZE      most events written per batch (500)
+  SPLANGO_WRITER_FLUSH_INTERVAL  seconds to wait for a batch to fill (1.0)
+  SPLANGO_WRITER_QUEUE_SIZE      events held before the queue is full (10000)
+  SPLANGO_WRITER_WHEN_FULL       what enqueueing does when the queue is full:
+                                 "sync" writes the event inline (default),
+                                 "block" waits for room, "drop" discards it.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
+
+from splango.models import Goal, GoalRecord, Enrollment, Experiment
+from splango.registry import experiment_registry
+
+WHEN_FULL_SYNC = "sync"
+WHEN_FULL_BLOCK = "block"
+WHEN_FULL_DROP = "drop"
+
+EVENT_GOAL = "goal"
+EVENT_ENROLL = "enroll"
+
+
+def _created(event, size):
+    """The time at the end of an event tuple read back from a file, or None
+    if the tuple is just size long."""
+    return event[size] if len(event) > size else None
+
+
+def write_goals(events):
+    """Write (subject_id, goal_name, request_info, extra) tuples, optionally
+    followed by the time the goal was reached. A goal is recorded at most
+    once per subject; like GoalRecord.record, a later event only
+    contributes its extra to a record that has none."""
+
+    if not events:
+        return
+
+    by_key = {}
+
+    for event in events:
+        subject_id, goal_name, request_info, extra = event[:4]
+        key = (subject_id, goal_name)
+
+        if key not in by_key:
+            by_key[key] = [request_info, extra, _created(event, 4)]
+        elif extra and not by_key[key][1]:
+            by_key[key][1] = extra
+
+    goal_ids = _goal_ids(set(name for (sid, name) in by_key))
+    subject_ids = set(sid for (sid, name) in by_key)
+
+    existing = set(GoalRecord.objects.filter(subject__in=subject_ids,
+                                             goal__in=goal_ids.values())
+                   .values_list("subject_id", "goal_id"))
+
+    new_records = []
+    times = []
+
+    for (subject_id, goal_name), (request_info, extra, created) in by_key.items():
+        goal_id = goal_ids[goal_name]
+
+        if (subject_id, goal_id) in existing:
+            if extra:
+                GoalRecord.objects.filter(
+                    Q(extra__isnull=True) | Q(extra=""),
+                    subject=subject_id, goal=goal_id).update(extra=extra)
+        else:
+            new_records.append(GoalRecord(subject_id=subject_id,
+                                          goal_id=goal_id,
+                                          extra=extra,
+                                          **request_info))
+
+            if created is not None:
+                times.append(({ "subject": subject_id, "goal": goal_id }, created))
+
+    _bulk_insert(GoalRecord, new_records, ("subject_id", "goal_id"))
+    _set_created(GoalRecord, times)
+
+
+def write_enrollments(events):
+    """Write (subject_id, exp_name, variant) tuples, optionally followed by
+    the time of the enrollment. The first enrollment
+    of a subject in an experiment wins, whether already in the database or
+    earlier in events. Returns {(subject_id, exp_name): variant} for the
+    enrollments that were already in the database."""
+
+    if not events:
+        return {}
+
+    exp_ids = _experiment_ids(set(e[1] for e in events))
+    exp_names = dict((v, k) for (k, v) in exp_ids.items())
+
+    by_key = {}
+
+    for event in events:
+        subject_id, exp_name, variant = event[:3]
+
+        if exp_name not in exp_ids:
+            logging.warn("Splango: dropped enrollment in unknown experiment %r" % exp_name)
+            continue
+
+        by_key.setdefault((subject_id, exp_ids[exp_name]),
+                          (variant, _created(event, 3)))
+
+    if not by_key:
+        return {}
+
+    existing = dict(((sid, exp_id), variant) for (sid, exp_id, variant) in
+                    Enrollment.objects.filter(
+            subject__in=set(sid for (sid, exp_id) in by_key),
+            experiment__in=set(exp_id for (sid, exp_id) in by_key))
+                    .values_list("subject_id", "experiment_id", "variant"))
+
+    new_enrollments = [ Enrollment(subject_id=sid, experiment_id=exp_id,
+                                   variant=variant)
+                        for (sid, exp_id), (variant, created) in by_key.items()
+                        if (sid, exp_id) not in existing ]
+
+    _bulk_insert(Enrollment, new_enrollments, ("subject_id", "experiment_id"))
+    _set_created(Enrollment,
+                 [ ({ "subject": sid, "experiment": exp_id }, created)
+                   for (sid, exp_id), (variant, created) in by_key.items()
+                   if created is not None and (sid, exp_id) not in existing ])
+
+    return dict(((sid, exp_names[exp_id]), variant)
+                for (sid, exp_id), variant in existing.items())
+
+
+def _goal_ids(names):
+    """Map goal names to ids, creating the goals that don't exist yet."""
+
+    ids = dict(Goal.objects.filter(name__in=names).values_list("name", "id"))
+    missing = names - set(ids)
+
+    if missing:
+        _bulk_insert(Goal, [ Goal(name=name) for name in missing ], ("name",))
+        ids.update(Goal.objects.filter(name__in=missing)
+                   .values_list("name", "id"))
+
+    return ids
+
+
+def _experiment_ids(names):
+    """Map experiment names to ids, from the registry where possible."""
+
+    ids = {}
+
+    for name in names:
+        exp = experiment_registry.get(name)
+
+        if exp is not None:
+            ids[name] = exp.pk
+
+    missing = names - set(ids)
+
+    if missing:
+        ids.update(Experiment.objects.filter(name__in=missing)
+                   .values_list("name", "id"))
+
+    return ids
+
+
+def _bulk_insert(model, objs, unique_fields):
+    """bulk_create objs, falling back to one get_or_create per row if
+    another process inserted a conflicting row in the meantime. Like
+    get_or_create, this uses a savepoint, so it leaves any surrounding
+    transaction (e.g. TransactionMiddleware's) open."""
+
+    if not objs:
+        return
+
+    sid = transaction.savepoint()
+
+    try:
+        model.objects.bulk_create(objs)
+        transaction.savepoint_commit(sid)
+
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        logging.info("Splango: bulk insert of %d %s rows conflicted; retrying row by row" % (len(objs), model.__name__))
+
+        for obj in objs:
+            lookup = dict((f, getattr(obj, f)) for f in unique_fields)
+            defaults = dict((f.attname, getattr(obj, f.attname))
+                            for f in model._meta.local_fields
+                            if not f.primary_key and f.attname not in lookup)
+            model.objects.get_or_create(defaults=defaults, **lookup)
+
+
+def _set_created(model, times):
+    """Give rows their original creation time, from a list of (lookup,
+    created) pairs. bulk_create can't do it, since auto_now_add overrides
+    whatever created the objects were given."""
+
+    for lookup, created in times:
+        model.objects.filter(**lookup).update(created=created)
+
+
+def write_events(events):
+    write_goals([ e[1:] for e in events if e[0] == EVENT_GOAL ])
+    write_enrollments([ e[1:] for e in events if e[0] == EVENT_ENROLL ])
+
+
+def _write_atomically(events):
+    """write_events, all or nothing: in a savepoint inside a surrounding
+    transaction, else in a transaction of its own."""
+
+    if not transaction.is_managed():
+        with transaction.commit_on_success():
+            write_events(events)
+        return
+
+    sid = transaction.savepoint()
+
+    try:
+        write_events(events)
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+
+    transaction.savepoint_commit(sid)
+
+
+class EventWriter(object):
+
+    def __init__(self, batch_size=500, flush_interval=1.0, queue_size=10000,
+                 when_full=WHEN_FULL_SYNC, background=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.when_full = when_full
+        self.background = background
+        self.queue = Queue.Queue(queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def enqueue_goal(self, subject_id, goal_name, request_info, extra=None):
+        self.enqueue((EVENT_GOAL, subject_id, goal_name, request_info, extra))
+
+    def enqueue_enrollment(self, subject_id, exp_name, variant):
+        self.enqueue((EVENT_ENROLL, subject_id, exp_name, variant))
+
+    def enqueue(self, event):
+        if self.background:
+            self.start()
+
+        if self.when_full == WHEN_FULL_BLOCK:
+            self.queue.put(event)
+            return
+
+        try:
+            self.queue.put_nowait(event)
+
+        except Queue.Full:
+            if self.when_full == WHEN_FULL_DROP:
+                logging.warn("Splango: write-behind queue full, dropped %r" % (event,))
+            else:
+                self.write([event])
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        with self._start_lock:
+            if self._thread is None:
+                t = threading.Thread(target=self._run,
+                                     name="splango-writer")
+                t.daemon = True
+                t.start()
+                self._thread = t
+
+    def write(self, events):
+        with self._write_lock:
+            try:
+                _write_atomically(events)
+                return
+            except Exception:
+                logging.warn("Splango: failed to write %d events; retrying one by one" % len(events))
+
+            # so one bad event only costs itself
+            for event in events:
+                try:
+                    _write_atomically([event])
+                except Exception:
+                    logging.exception("Splango: dropped event %r" % (event,))
+
+    def next_batch(self, timeout):
+        """Collect up to batch_size events, waiting at most timeout seconds
+        for the first one and for the batch to fill."""
+        batch = []
+        deadline = time.time() + timeout
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        return batch
+
+    def flush(self):
+        """Write everything currently queued, in the calling thread."""
+        while True:
+            batch = self.next_batch(0)
+
+            if not batch:
+                return
+
+            self.write(batch)
+
+    def _run(self):
+        while True:
+            batch = self.next_batch(self.flush_interval)
+
+            if batch:
+                self.write(batch)
+                # don't hold a connection open while idle
+                connection.close()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, "SPLANGO_WRITE_BEHIND", False)
+
+
+def get_writer():
+    """Return the process-wide EventWriter, creating it on first use."""
+    global _writer
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = EventWriter(
+                    batch_size=getattr(settings, "SPLANGO_WRITER_BATCH_SIZE", 500),
+                    flush_interval=getattr(settings, "SPLANGO_WRITER_FLUSH_INTERVAL", 1.0),
+                    queue_size=getattr(settings, "SPLANGO_WRITER_QUEUE_SIZE", 10000),
+                    when_full=getattr(settings, "SPLANGO_WRITER_WHEN_FULL", WHEN_FULL_SYNC))
+                atexit.register(_writer.flush)
+
+    return _writer